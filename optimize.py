@@ -4,7 +4,7 @@
 
 # DEPENDENCIES:
 #   python3
-#   python-magic (pip3 install magic-python) https://github.com/ahupp/python-magic
+#   python-magic (recommended, pip3 install python-magic) https://github.com/ahupp/python-magic
 #
 #   7zip (https://www.7-zip.org/)
 #   AdvanceCOMP Utilities (https://www.advancemame.it/comp-readme)
@@ -13,7 +13,7 @@
 #   flac (https://xiph.org/flac/)
 #   jpegoptim (https://github.com/tjko/jpegoptim)
 #   optipng (http://optipng.sourceforge.net/)
-#   pngcrush (not yet used)
+#   pngcrush (optional, with --pngcrush)
 #
 # OPTIONAL:
 #   file
@@ -21,8 +21,15 @@
 from pathlib import Path
 from shutil import rmtree
 from sys import argv, exit, platform
-from subprocess import run
-import gzip
+from io import StringIO
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+import builtins
+import errno
+import os
+import sys
+import threading
+import zlib
 
 
 ### BEGIN ARGUMENTS
@@ -48,12 +55,33 @@ def define_arguments():
 		action="store_true",
 		dest="use_recursion")
 
+	# Filter which files are processed. Matched against the file name and its path inside the searched directory.
+	parser.add_argument("--include",
+		help="Only process files matching this glob pattern, such as '*.png'. Can be used more than once.",
+		action="append",
+		default=[],
+		metavar="PATTERN",
+		dest="include")
+
+	parser.add_argument("--exclude",
+		help="Skip files and directories matching this glob pattern, such as '.git' or 'cache/*'. Excluded directories are not searched at all. Can be used more than once.",
+		action="append",
+		default=[],
+		metavar="PATTERN",
+		dest="exclude")
+
 	# Convert gzip to 7zip. Default is to do nothing.
 	parser.add_argument("-g", "--convert-gzip",
 		help="Recompress gzipped files as 7zip.",
 		action="store_true",
 		dest="convert_gzip")
 
+	# Recompress gzip as xz inside Python instead of with 7zip.
+	parser.add_argument("--gzip-to-xz",
+		help="With --convert-gzip, recompress as xz using Python's built-in lzma instead of 7zip. Also used when 7zip is not installed.",
+		action="store_true",
+		dest="gzip_to_xz")
+
 	# Strip metadata from JPGs
 	parser.add_argument("-j", "--strip-jpg", "--strip-jpeg",
 		help="Strip metadata from JPGs. Otherwise JPGs left untouched.",
@@ -63,10 +91,24 @@ def define_arguments():
 
 	# Convert PNGs to WebP instead of using the usual PNG compression method
 	parser.add_argument("-p", "--convert-png",
-		help="Convert PNG files to WebP.",
+		help="Also try converting PNG files to WebP. The smaller of the PNG and WebP is kept.",
 		action="store_true",
 		dest="convert_png")
 
+	# Also try PNGCrush as one of the PNG strategies.
+	parser.add_argument("--pngcrush",
+		help="Also try PNGCrush when optimizing PNGs.",
+		action="store_true",
+		dest="use_pngcrush")
+
+	# Stop slow PNG strategies once one has finished.
+	parser.add_argument("--png-time-budget",
+		help="Seconds to spend on each PNG. Strategies still running after this are stopped, as long as one has already finished. (Default: no limit)",
+		type=float,
+		default=None,
+		metavar="SECONDS",
+		dest="png_time_budget")
+
 	# Convert wav to FLAC. Default is to do nothing.
 	parser.add_argument("-w", "--convert-wav",
 		help="Convert wav files to FLAC.",
@@ -87,19 +129,215 @@ def define_arguments():
 		#dest="ignore_compatibility"
 		#)
 
-	#parser.add_argument("-7", "--optimize-7z-contents",
-		#help="Optimize contents of 7zip files before recompressing.",
-		#action="store_true",
-		#dest="optimize_7z_contents")
+	parser.add_argument("-7", "--optimize-7z-contents",
+		help="Optimize contents of 7zip files before recompressing.",
+		action="store_true",
+		dest="optimize_7z_contents")
 
-	#parser.add_argument("-z", "--optimize-zip-contents",
-		#help="Optimize contents of zip files before recompressing.",
-		#action="store_true",
-		#dest="optimize_zip_contents")
+	parser.add_argument("-z", "--optimize-zip-contents",
+		help="Optimize PNG and JPEG images inside zip, OpenDocument, MS Office and EPUB files before recompressing.",
+		action="store_true",
+		dest="optimize_zip_contents")
+
+	# Process several files at once. `-j` is already taken by --strip-jpg.
+	parser.add_argument("-J", "--jobs",
+		help="Number of files to optimize at the same time. Without a number, uses one job per CPU core. (Default: 1)",
+		type=int,
+		# "?" lets the flag be used alone. `const` is the value used when no number follows it.
+		nargs="?",
+		const=os.cpu_count() or 1,
+		default=1,
+		dest="jobs")
+
+	parser.add_argument("--io-jobs",
+		help="With --jobs, number of files that may be copying back or hashing at the same time, on top of the tools already running. Raise it for slow network drives. (Default: 4)",
+		type=int,
+		default=4,
+		dest="io_jobs")
+
+	# Run the optimizers over many files per call instead of starting a new process for each file.
+	parser.add_argument("-b", "--batch",
+		help="Optimize PNG, JPEG and zip files in groups, with one run of each tool per group. Saves process start-up time on many small files.",
+		action="store_true",
+		dest="batch")
+
+	parser.add_argument("--batch-size",
+		help="Most files to hand a tool in one run when using --batch. (Default: 100)",
+		type=int,
+		default=100,
+		dest="batch_size")
+
+	# Use past results to skip tools that don't pay off.
+	parser.add_argument("--budget",
+		help="Skip tools and PNG strategies that have saved less than this percentage on similar files in past runs. (Default when used without a number: 0.5)",
+		type=float,
+		nargs="?",
+		const=0.5,
+		default=None,
+		metavar="PERCENT",
+		dest="budget")
+
+	# Skip files that look like earlier optimizers already got everything out of them.
+	parser.add_argument("--min-gain",
+		help="Skip PNG, JPEG and zip files that a quick check predicts will shrink by less than this percentage. (Default when used without a number: 1)",
+		type=float,
+		nargs="?",
+		const=1.0,
+		default=None,
+		metavar="PERCENT",
+		dest="min_gain")
+
+	# Where to write candidate files before the best one is copied back.
+	parser.add_argument("--scratch-dir",
+		help="Directory for temporary files. Only the final result is written next to the original. (Default: /dev/shm if available, otherwise the system temp directory)",
+		default=None,
+		metavar="DIR",
+		dest="scratch_dir")
+
+	# Write what happened to each file somewhere a program can read it.
+	parser.add_argument("--report",
+		help="Write a line of JSON for each file to this file as they finish, followed by a summary of the run.",
+		default=None,
+		metavar="FILE",
+		dest="report_file")
+
+	# Skip files an earlier run already optimized.
+	parser.add_argument("--no-cache",
+		help="Do not skip files that an earlier run already optimized, and do not remember results from this run.",
+		action="store_false",
+		dest="use_cache")
+
+	parser.add_argument("--cache-size",
+		help="Maximum number of optimized files to remember. Least recently seen files are forgotten first. (Default: 100000)",
+		type=int,
+		default=100000,
+		dest="cache_size")
+
+	# Pick up where an interrupted run left off.
+	parser.add_argument("--resume",
+		help="Skip files that the last run finished and that have not changed since. Use after a run was interrupted.",
+		action="store_true",
+		dest="resume")
+
+	parser.add_argument("--journal",
+		help="File that records each finished file so the run can be resumed. Give runs that overlap in time their own journal. (Default: one in the cache directory for each set of files and options, removed when the run finishes)",
+		default=None,
+		metavar="FILE",
+		dest="journal_file")
+
+	# Keep big jobs from running the machine out of memory.
+	parser.add_argument("--max-memory",
+		help="With --jobs, only start a file when the estimated memory of everything running, plus its own, stays under this. Accepts K, M, G and T suffixes, such as 8G. A file that needs more than this on its own is optimized alone. (Default: no limit)",
+		type=parse_size,
+		default=None,
+		metavar="SIZE",
+		dest="max_memory")
+
+	# See where the time goes.
+	parser.add_argument("--profile",
+		help="Print how much time, CPU time and I/O went to each stage (detecting types, pre-checks, hashing, each tool, comparing and committing results), and to each mime-type, at the end of the run.",
+		action="store_true",
+		dest="profile")
+
+	parser.add_argument("--profile-hook",
+		help="Call this function, given as module:function, with a dict for every stage of every file: stage, type, path, wall_time, cpu_time, bytes_read and bytes_written. Use it to send the numbers to a metrics system. Can be given more than once, and works without --profile.",
+		type=load_profile_hook,
+		action="append",
+		default=[],
+		metavar="MODULE:FUNCTION",
+		dest="profile_hooks")
+
+	# Split one run between several processes.
+	parser.add_argument("--manifest",
+		help="Share the work with other processes using the same manifest file, on this machine or others that see the same storage at the same path. The first process walks the files it is given into the manifest. Others can be started with no files. Use the same options for each.",
+		default=None,
+		metavar="FILE",
+		dest="manifest_file")
+
+	parser.add_argument("--lease",
+		help="With --manifest, seconds before the files a crashed process claimed are handed to another. Running processes renew their claims well before then. (Default: 300)",
+		type=float,
+		default=300.0,
+		metavar="SECONDS",
+		dest="lease_time")
+
+	parser.add_argument("--manifest-report",
+		help="With --manifest, the last process to finish writes every process's results here, in the same form as --report.",
+		default=None,
+		metavar="FILE",
+		dest="manifest_report")
+
+	# Keep running and optimize files as they arrive.
+	parser.add_argument("--watch",
+		help="Watch the given directories, and with -r everything inside them, and optimize files as they are written until stopped with Ctrl+C. Files already there are left alone. Linux only.",
+		action="store_true",
+		dest="watch")
+
+	parser.add_argument("--watch-delay",
+		help="With --watch, seconds a file must go unwritten before it is optimized, so files still being copied in are left alone. (Default: 2)",
+		type=float,
+		default=2.0,
+		metavar="SECONDS",
+		dest="watch_delay")
+
+	# Optimize each set of identical files once.
+	parser.add_argument("--dedup",
+		help="Optimize only one of each set of files with the same contents, and copy the result over the others. With `hardlink`, the others become hard links to it and share its permissions. Every file is found before any is optimized. (Default when used without a mode: copy)",
+		nargs="?",
+		const="copy",
+		default=None,
+		choices=("copy", "hardlink"),
+		metavar="MODE",
+		dest="dedup")
+
+	# Show what's installed.
+	parser.add_argument("--list-tools",
+		help="List the optimizers this script uses, where each one was found and its version, then quit.",
+		action="store_true",
+		dest="list_tools")
+
+	# Measure how fast the optimizers are, on files generated for the purpose.
+	parser.add_argument("--bench",
+		help="Generate a test corpus of PNG, JPEG, WAV, FLAC, gzip, zip and Word files in DIR (default: the system temp directory), time optimizing it with each of --bench-jobs and --bench-profiles, then quit. Files given on the command line are ignored.",
+		nargs="?",
+		const="",
+		default=None,
+		metavar="DIR",
+		dest="bench")
+
+	parser.add_argument("--bench-jobs",
+		help="Comma-separated job counts to benchmark. (Default: 1 and the number of CPU cores)",
+		default=None,
+		metavar="LIST",
+		dest="bench_jobs")
+
+	parser.add_argument("--bench-profiles",
+		help="Comma-separated effort settings to benchmark: fast (--png-time-budget 1 --min-gain), default, batch (--batch) and all (-A). (Default: default,all)",
+		default="default,all",
+		metavar="LIST",
+		dest="bench_profiles")
+
+	parser.add_argument("--bench-scale",
+		help="Multiply the number of files in the benchmark corpus. (Default: 1, about 40 files)",
+		type=int,
+		default=1,
+		dest="bench_scale")
+
+	parser.add_argument("--bench-save",
+		help="Save the benchmark's numbers to this file as JSON, to compare later runs against.",
+		default=None,
+		metavar="FILE",
+		dest="bench_save")
+
+	parser.add_argument("--bench-compare",
+		help="Show the change from numbers saved earlier with --bench-save.",
+		default=None,
+		metavar="FILE",
+		dest="bench_compare")
 
 	# Shortcut to 
 	parser.add_argument("-A", "--all-optimizations",
-		help="Enable all conversion optimizations (same as -jw). Use twice to enable less common conversion optimizations and destructive optimizations (-gjpw).",
+		help="Enable all conversion optimizations (same as -jwz7). Use twice to enable less common conversion optimizations and destructive optimizations (-gjpwz7).",
 		action="count",
 		default=0,
 		dest="all_optimizations")
@@ -128,588 +366,3787 @@ else:
 	#UNDERLINE = '\033[4m'
 
 
-def keep_smaller_file(original_file, new_file):
-	# Compare the size of each file. Remove the larger file.
-	try:
-		if Path(new_file).stat().st_size < Path(original_file).stat().st_size:
-			print("New file was smaller in size.")
-			Path(original_file).unlink()
+# Keep whichever of the original and the newly made file is smaller. The new file is usually in the scratch workspace.
+# If it wins it is moved to `target_file`, which defaults to replacing the original in place. Give the new name when the format changed.
+# Returns the path of whichever file was kept, or None if they could not be compared.
+def keep_smaller_file(original_file, new_file, target_file=None):
+	target_file = Path(target_file or original_file)
+	
+	with profiled('compare'):
+		# Compare the size of each file. Remove the larger file.
+		# The original's size and permissions were already taken when it was opened, if this thread opened it.
+		info = current_file_info(original_file)
+		try:
+			original_size = info.size if info is not None else Path(original_file).stat().st_size
+			if Path(new_file).stat().st_size < original_size:
+				# Never overwrite some other file that happens to have the new name.
+				if target_file != Path(original_file) and target_file.exists():
+					print(f"{WARNING}New file was smaller, but {target_file} already exists. Keeping the original.{ENDC}")
+					discard_file(new_file)
+					return original_file
+				
+				print("New file was smaller in size.")
+				# The new file is safely in place before the original is removed. A crash in between leaves both, never neither.
+				commit_file(new_file, target_file, mode_from=info.stat.st_mode if info is not None else original_file)
+				if target_file != Path(original_file):
+					Path(original_file).unlink()
+				kept_file = target_file
+			else:
+				# Not deleting old file under all other else conditions is fail safe.
+				print("Original file was smaller or equal in size.")
+				discard_file(new_file)
+				kept_file = original_file
+			
+			print("Smaller file will be kept.")
+		except OSError as error:
+			print(f"Unable to compare files. Was the original already deleted? ({error})")
+			discard_file(new_file)
+			return None
+		
+		return kept_file
+
+
+# Move a finished file to where it belongs without ever leaving a half-written file under the real name.
+# Files from another filesystem (like a tmpfs workspace) are copied next to the target first, so only one copy crosses over.
+# The final step is an atomic rename, and everything is flushed to disk before and after it.
+# `mode_from` is a file to copy permissions from, or the permission bits themselves.
+def commit_file(source, target, mode_from=None):
+	from shutil import copyfileobj, copymode
+	
+	source, target = Path(source), Path(target)
+	with profiled('commit'), io_slot():
+		if source.parent.stat().st_dev == target.parent.stat().st_dev:
+			staged = source
+			with open(staged, 'rb+') as f:
+				os.fsync(f.fileno())
 		else:
-			# Not deleting old file under all other else conditions is fail safe.
-			print("Original file was smaller or equal in size.")
-			Path(new_file).unlink()
-		
-		print("Smaller file will be kept.")
-		
-		# If original file was removed and new_file still exists, rename to remove temp extension.
-		# TODO: This will rename it to have the wrong file extension sometimes?
-		# Cannot just use the original file to rename because it may have been in a different format.
-		if Path(new_file).exists():
-			Path(new_file).rename(new_file.with_suffix(""))
-		# If original file still exists, then nothing to do. New file should have been removed if it was larger.
-	except:
-		print("Unable to compare files. Was the original already deleted?")
+			staged = target.with_name(f'.{target.name}.{os.getpid()}.tmp')
+			try:
+				with open(source, 'rb') as src, open(staged, 'wb') as dst:
+					copyfileobj(src, dst, stream_chunk_size)
+					dst.flush()
+					os.fsync(dst.fileno())
+					profile_bytes(read=dst.tell(), written=dst.tell())
+			except BaseException:
+				discard_file(staged)
+				raise
+		
+		# Keep the original file's permissions.
+		if isinstance(mode_from, int):
+			from stat import S_IMODE
+			os.chmod(staged, S_IMODE(mode_from))
+		elif mode_from is not None:
+			copymode(mode_from, staged)
+		
+		os.replace(staged, target)
+		fsync_dir(target.parent)
+		if staged != source:
+			discard_file(source)
 
 
-def compress_to_7z(file):
-	print("Creating 7zip container...")
-	run([x7z, 'a', '-t7z', '-m0=lzma2', '-mx=9', '-myx=9', '-mqs=on', '-ms=on', f'{file}.7z', file])
+# Make a rename inside a directory survive a crash. Windows can't open directories, and doesn't need to.
+def fsync_dir(directory):
+	if platform.startswith('win32'):
+		return
+	fd = os.open(directory, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
 
 
-### END SUPPORT FUNCTIONS
+# Scratch directory for candidate files. Candidates are written and compared here, and only the winner is copied back.
+# Defaults to shared memory (tmpfs) on Linux, so losing candidates never touch the real disk.
+class Workspace:
+	def __init__(self, base_dir=None):
+		from tempfile import mkdtemp, gettempdir
+		from itertools import count
+		
+		if base_dir is None:
+			base_dir = '/dev/shm' if os.access('/dev/shm', os.W_OK) else gettempdir()
+		remove_stale_workspaces(base_dir)
+		while True:
+			# Absolute, so paths in it still work for tools run from another directory.
+			self.dir = Path(mkdtemp(prefix=f'{workspace_prefix()}{os.getpid()}-', dir=base_dir)).resolve()
+			# Held until close(), so other runs can tell this workspace is in use.
+			# Another run cleaning up may have locked it first, in which case it is being removed and a new one is needed.
+			self.lock_fd = lock_workspace(self.dir)
+			if self.lock_fd is not False:
+				break
+		self.names = count()
 
+	# A new, unused path for a candidate made from `file`. Nothing is created yet, since some tools refuse to overwrite files.
+	# Large files go next to the original instead when the workspace is short on space.
+	# `size` is the space it will need, if that's more than twice the original's size, such as for unpacked archives.
+	def new_file(self, file, suffix, size=None) -> Path:
+		if size is None:
+			try:
+				size = Path(file).stat().st_size * 2
+			except OSError:
+				size = 0
+		return self.new_path(f'{Path(file).stem}{suffix}', size, Path(file).resolve().parent)
 
-### BEGIN OPTIMIZATION FUNCTIONS
+	# A new, unused path for a file called `name` that will take `size` bytes, for files that aren't on disk yet, like members of an archive.
+	# Only the last part of `name` is used. It goes in `fallback_dir` instead when the workspace is short on space.
+	def new_path(self, name, size, fallback_dir) -> Path:
+		from shutil import disk_usage
+		
+		name = f'{next(self.names)}-{Path(name).name}'
+		try:
+			if disk_usage(self.dir).free < size:
+				return Path(fallback_dir).resolve() / f'.{name}.tmp'
+		except OSError:
+			pass
+		return self.dir / name
 
-# Commands to optimize files.
-optimize_msg = "Optimizing {} file."
+	def close(self):
+		rmtree(self.dir, ignore_errors=True)
+		if self.lock_fd is not None:
+			os.close(self.lock_fd)
+			self.lock_fd = None
 
 
-def optimize_7z(file, optimize_7z_contents=False):
-	print(optimize_msg.format("7zip"))
-	print("7zip not yet supported. Sorry. :c")
+# Start of this host's workspace names. The scratch directory may be shared storage used by runs on other machines.
+def workspace_prefix():
+	import socket
+	return f"optpymize-{socket.gethostname().replace('-', '_')}-"
 
-	# TODO: Everything
-	# Extract the files to a known directory.
-	# Unpack
-	# Lack of space after switch is intentional. 7z's command line interface is bad.
-	#7z x -o"${file%.7[zZ]}" "$file"
-	
-	# new_file = f'{file.rsplit(".", 1)[0]}.7z.tmp'
-	#run(['7z', 'x', f'-o"{new_file}', file])
-	
-	# Provides a predictable destination for extracted files. Use this because 7z doesn't have a nice way of getting them otherwise.  ./${file%.7[zZ]}/*
-	
-	# Does not delete original archive. Do at end if new size smaller.
-	
-	# Optionally optimize archive contents.
-	#if optimize_7z_contents:
-		# Optimize everything in the directory.
-		#optimize_file(extracted, recursion=True)
-	#else:
-	#	print("Skipping individual file optimization.")
-	
-	# Repack
-	#compress_7z("./${file%.7[zZ]}/")
+
+# Take the lock on the workspace at `path`, creating its lock file if needed.
+# Returns the lock file's descriptor, False if another process holds it, or None where locks aren't available.
+def lock_workspace(path, create=True):
+	try:
+		import fcntl
+	except ImportError:
+		return None
 	
-	# Confirm repack smaller than original
-	#keep_smaller_file(file, new_file)
+	try:
+		fd = os.open(Path(path) / '.lock', os.O_RDWR | (os.O_CREAT if create else 0))
+	except OSError:
+		return None if create else False
+	try:
+		fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except OSError:
+		os.close(fd)
+		return False
+	return fd
 
-#def optimize_archive_contents(file, destructive=False):
-	# Delete unecessary resource fork in archives created on Mac computers.
-	# https://en.wikipedia.org/wiki/Resource_fork
-	# https://superuser.com/questions/104500/what-is-macosx-folder
-	#if destructive:
-		# Delete _MACOSX directory.
-		#shutil.rmtree("_MACOSX")
-		# Delete .DS_Store files.
-		#Path.unlink(".DS_Store")
 
+# Clean up after runs that crashed. Only this host's workspaces are looked at, and only ones that no running process holds the lock on are removed.
+def remove_stale_workspaces(base_dir):
+	for path in Path(base_dir).glob(f'{workspace_prefix()}*'):
+		fd = lock_workspace(path, create=False)
+		if fd is None or fd is False:
+			continue
+		# Removed while still locked, so a run that just made it can't start using it meanwhile.
+		try:
+			rmtree(path, ignore_errors=True)
+		finally:
+			os.close(fd)
 
-def optimize_gz(file, convert_gzip=False):
-	print(optimize_msg.format("gzipped"))
 
-	if convert_gzip:
-		# Decompress
-		decompressed_file = Path(file).with_suffix('')
-
-		# Open and write out decompressed gz file.
-		with open(decompressed_file, 'wb') as f:
-			with gzip.open(file, 'rb') as g:
-				f.write(g.read())
-		# Close files to prevent memory leaks in PyPy.
-				g.close()
-			f.close()
-		
-		# Recompress to 7zip
-		# TODO: Will cannibalize any files that have the filename.7z
-		compress_to_7z(decompressed_file)
-		
-		# Cleanup
-		remove(decompressed_file)
-		
-		# Check that 7zip file is smaller than original
-		keep_smaller_file(file, f'{decompressed_file}.7z')
-	else:
-		print(f"Skipping {file}. Converting gzip to 7zip not enabled.")
+# The Optimizer each thread is working for. The functions below use its workspace, tool slots and profiler.
+# Its pool's threads are set up with it, calls on the thread using it switch to it while they run, and helper threads get it from for_file().
+# Several Optimizers can be used at once this way, each with its own.
+optimizer_context = threading.local()
 
+def current_optimizer():
+	return getattr(optimizer_context, 'optimizer', None)
 
-def optimize_flac(file):
-	print(optimize_msg.format("FLAC"))
-	print(f"Re-compressing {file}...")
-	
-	# Set filename for new file.
-	new_file = Path(file).with_suffix('.flac.tmp')
-	
-	# Use appropriate command for appropriate system.
-	try:
-		# Compress FLAC at maximum compression.
-		run([flac, file, '-f', '-V', '--compression-level-8', '-o', new_file])
-	except:
-		print("Please install `flac` to continue.")
-	
-	# Compare file size, delete the smaller one, rename if necessary.
-	try:
-		keep_smaller_file(file, new_file)
-	except:
-		print("Could not compare file size between wav and FLAC.")
 
+# The workspace used by the optimizers, made the first time it is needed. Runs where every file is skipped never make one.
+# Optimizers keep their own. Functions called without one share this one, which is removed when the program exits.
+workspace = None
+workspace_lock = threading.Lock()
 
-def optimize_jpeg(file, strip_jpg=False):
-	print(optimize_msg.format("JPEG image"))
+def get_workspace() -> Workspace:
+	optimizer = current_optimizer()
+	if optimizer is not None:
+		return optimizer.get_workspace()
+	
+	global workspace
+	with workspace_lock:
+		if workspace is None:
+			import atexit
+			workspace = Workspace()
+			atexit.register(workspace.close)
+		return workspace
 
-	if strip_jpg:
-		run([jpegoptim, '--strip-all', file])
-	else:
-		print(f"{WARNING}Option `--strip-jpg` not set. Metadata will be untouched.{ENDC}")
-		run([jpegoptim, file])
 
+# How many external tools, and how many copies and hashes, may run at once. An Optimizer sets them up for parallel runs.
+# They are counted separately so files waiting on a slow disk don't keep the CPU idle, and busy tools don't hold up the disk work.
+def cpu_slot():
+	optimizer = current_optimizer()
+	return optimizer.cpu_slots if optimizer is not None else nullcontext()
 
-def optimize_odf(file, delete_thumbnails=False, ignore_compatibility=False):
-	print(optimize_msg.format("OpenDocument Format file"))
-	
-	# Delete bulky thumbnail from file.
-	#if delete_thumbnails:
-		#print("Removing thumbnail...")
-		
-		#print("Making temp...")
-		#temp_dir = str(Path(file).with_suffix("")) + "_TEMP"
-		
-		## Contents are inside a zip file. Extract it.
-		#run([x7z, 'x', file, f'-o{temp_dir}'])
-		
-		#print("Deleting ", str(Path(temp_dir, 'Thumbnails')))
-		
-		## Delete the contents of `./Thumbnails` directory and itself
-		#rmtree(Path(temp_dir, 'Thumbnails'))
-		
-		## Optimize image files and such embedded in the document?
-		## This is in `./Pictures`
-		## Do not use the user-set optimization options. If a file changes formats, the file index will lose it.
-		##optimize_file(files_in_directory, convert_png=False)
-		
-		#print("Recompressing...")
-		## Recompress to temp file
-		#temp_file = f'{file}.tmp'
-		
-		## Includes must use absolute path or 7zip will include leading folders as well.
-		#include = [ x.resolve() for x in list(Path(temp_dir).glob('*'))]
-		
-		#print(include)
-		
-		## TODO: Both archive managers change the mime-type to `application/zip` instead of `application/vnd.oasis.opendocument.text`
-		## https://docs.oasis-open.org/office/v1.2/os/OpenDocument-v1.2-os-part3.html#__RefHeading__752791_826425813
-		## The mimetype file must be first in the archive and uncompressed.
-		## Consider: https://pypi.org/project/odfdo/
-		#if ignore_compatability:
-			## WARNING: Advzip will automatically exclude empty directories.
-			## This improves file size, but may affect standards compatibility.
-			#run([advzip, '-a4', temp_file, *include])
-		#else:
-			## Deflate is the only algerythm accepted in the OpenDoc standard.
-			#run([x7z, 'a', '-tzip', '-mm=deflate', '-x0', temp_file, *include])
-			#optimize_zip(temp_file)
-		
-		## Delete decompressed directory
-		##rmtree(temp_dir)
-		
-		##keep_smaller_file(file, temp_file)
-	#else:
-		# Recompress it with ADVzip
-	print("Optimizing zip compression.")
-	optimize_zip(file)
+def io_slot():
+	optimizer = current_optimizer()
+	return optimizer.io_slots if optimizer is not None else nullcontext()
 
 
-def optimize_ms_office(file):
-	print(optimize_msg.format("MS Office File"))
-	
-	# Recompress it with ADVzip
-	print("Optimizing zip compression.")
-	optimize_zip(file)
+# Where --profile's numbers go. An Optimizer has one when profiling, and everything below does nothing without it.
+def current_profiler():
+	optimizer = current_optimizer()
+	return optimizer.profiler if optimizer is not None else None
 
+# The stages each thread is inside of, innermost last. Each entry is
+# [wall clock at start, thread CPU at start, wall time of children, CPU time of children, bytes read, bytes written].
+profile_stack = threading.local()
 
-#def optimize_pdf(file):
-	# Probably use Ghostscript or something.
-	# https://stackoverflow.com/questions/10450120/optimize-pdf-files-with-ghostscript-or-other
-	# https://askubuntu.com/questions/113544/how-can-i-reduce-the-file-size-of-a-scanned-pdf-file
-	# http://tuxdiary.com/2015/04/07/compress-pdf-files-linux/
-	# Offer OCR?  ocrmypdf
+# Time a stage of optimizing a file, such as `with profiled('detect'):`.
+# Stages can be nested. Each one is charged only for the time not spent in the stages inside it.
+def profiled(stage):
+	return ProfiledStage(stage) if current_profiler() is not None else nullcontext()
 
+class ProfiledStage:
+	def __init__(self, stage):
+		self.stage = stage
 
-def optimize_png(file, convert_png=False):
-	# TODO: APNGs will be completely broken by the optimizers. Need a way to identify them before it reaches here and skip them.
-	# Consider also: https://sourceforge.net/projects/apng/files/APNG_Optimizer/
-	# And to convert to animated WebP: https://github.com/Benny-/apng2webp
-	# Will need to write something custom to search the file for an Animation Control Chunk.
-	#  - https://stackoverflow.com/questions/47104481/bash-script-check-if-image-is-animated-png-apng
-	#  - https://wiki.mozilla.org/APNG_Specification
-	
-	print(optimize_msg.format("PNG image"))
-	
-	if convert_png:
-		print("Converting PNG to WebP...")
-		optimize_webp(file)
-	else:
-		print("Optimizing PNGs...")
-		
-		# TODO: Consider adding PNGCrush. It hasn't given good results though.
-		
-		try:
-			print("Using OptiPNG...")
-			run([optipng, '-o7', '-fix', file])
-		except:
-			print("Please install OptiPNG to improve compression. (http://optipng.sourceforge.net/)")
-		
-		# AdvPNG should be run last.
-		try:
-			print("Using AdvPNG...")
-			run([advpng, '-z4', file])
-		except:
-			print("Please install AdvanceCOMP Utilities to use AdvPNG. (https://www.advancemame.it/comp-readme)")
+	def __enter__(self):
+		from time import monotonic, thread_time
+		self.frame = [monotonic(), thread_time(), 0.0, 0.0, 0, 0]
+		profile_stack.__dict__.setdefault('stages', []).append(self.frame)
+		return self
 
+	def __exit__(self, *exc_info):
+		from time import monotonic, thread_time
+		started, cpu_started, child_wall, child_cpu, read, written = profile_stack.stages.pop()
+		wall_time = monotonic() - started
+		cpu_time = thread_time() - cpu_started
+		if profile_stack.stages:
+			profile_stack.stages[-1][2] += wall_time
+			profile_stack.stages[-1][3] += cpu_time
+		record_stage(self.stage, wall_time - child_wall, cpu_time - child_cpu, read, written)
 
-def optimize_wav(file, convert_wav=False):
-	print(optimize_msg.format("WAV"))
-	
-	if convert_wav:
-		print("Converting wav file to FLAC...")
-		
-		try:
-			optimize_flac(file)
-		except TypeError:
-			print("Failed to convert wav to FLAC.")
-		
-		# Delete original wav file if flac was created successfully.
-		if Path(file).with_suffix('.flac').exists():
-			try:
-				Path(file).unlink()
-			except:
-				pass
+# Count bytes towards the stage this thread is in.
+def profile_bytes(read=0, written=0):
+	stages = getattr(profile_stack, 'stages', None)
+	if stages and current_profiler() is not None:
+		stages[-1][4] += read
+		stages[-1][5] += written
+
+# Keep a finished stage with the file being optimized, so it can be reported under that file's type once it's known.
+# Work done outside of any file goes to the profiler straight away.
+def record_stage(stage, wall_time, cpu_time, read=0, written=0, usage=None):
+	profiler = current_profiler()
+	if profiler is None:
+		return
+	usage = usage or current_tool_usage()
+	if usage is not None:
+		usage.stages.append((stage, wall_time, cpu_time, read, written))
 	else:
-		print("Leaving WAV as is.")
+		profiler.add(None, None, [(stage, wall_time, cpu_time, read, written)], files=0)
 
 
-#def optimize_rar(file):
-	# TODO: If cbr, convert to cbz. Else, convert to 7z.
+# Remove a temp file if it was created.
+def discard_file(file):
+	try:
+		Path(file).unlink()
+	except OSError:
+		pass
 
 
-#def optimize_txt(file):
-	# TODO: Strip trailing white-space off the ends of lines.
+# Strongest 7zip settings. Shared by everything that creates a 7zip container.
+x7z_options = ['-t7z', '-m0=lzma2', '-mx=9', '-myx=9', '-mqs=on', '-ms=on']
 
+# Size of the pieces streamed between files and tools, so large files never have to fit in memory.
+stream_chunk_size = 1024 * 1024
 
-def optimize_webp(file):
-	print(optimize_msg.format("WebP image"))
 
-	# Set filename for new file.
-	new_file = Path(file).with_suffix('.webp.tmp')
+# Smallest dictionary, from 1 MB up to 256 MB, that holds all of `content_size`.
+def x7z_dictionary(content_size) -> int:
+	megabyte = 1024 ** 2
+	dictionary = megabyte
+	while dictionary < content_size and dictionary < 256 * megabyte:
+		dictionary *= 2
+	return dictionary
 
-	try:
-		run([cwebp, '-z', '9', file, '-o', new_file])
-	except:
-		print("Please install `cwebp` and try again.")
-	
-	# Compare file size, delete the smaller one, rename if necessary.
-	if Path(new_file).exists():
-			keep_smaller_file(file, new_file)
 
+# The 7zip settings above, with the dictionary and solid blocks sized for `content_size` bytes of input, using every core.
+# A dictionary bigger than the input only wastes memory (7zip needs about ten times the dictionary size to compress).
+# Small archives go in one solid block for the best ratio. Large ones are split into blocks of four dictionaries so LZMA2 can compress blocks on separate cores.
+def x7z_tuned_options(content_size) -> list:
+	megabyte = 1024 ** 2
+	dictionary = x7z_dictionary(content_size)
+	solid = '-ms=on' if content_size <= dictionary else f'-ms={dictionary * 4 // megabyte}m'
+	return [*(option for option in x7z_options if not option.startswith('-ms=')), solid, f'-md={dictionary // megabyte}m', '-mmt=on']
 
-def optimize_zip(file, optimize_zip_contents=False):
-	print(optimize_msg.format("Zip container"))
-	
-	#if optimize_zip_contents:
-		# Extract zip file
-		
-		# Optimize contents
-		#optimize_file('extracted-file-directory')
+
+# The total size of the files inside a 7zip container, or None if 7zip can't list them.
+def x7z_unpacked_size(file):
+	from subprocess import DEVNULL, PIPE
 	
 	try:
-		run([advzip, '-z4', file])
-	except:
-		print("Please install the AdvanceCOMP utilities and try again.\n",
-			"https://www.advancemame.it/comp-readme")
+		with cpu_slot():
+			process = start_tool([x7z, 'l', '-slt', file], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL)
+			with process.stdout:
+				listing = process.stdout.read()
+			wait_for_tool(process)
+	except OSError:
+		return None
+	if process.returncode != 0:
+		return None
+	# Each file has a "Size = " line. The archive's own size is on a "Physical Size = " line.
+	return sum(int(line[7:]) for line in listing.splitlines() if line.startswith(b'Size = '))
 
-### END OPTIMIZATION FUNCTIONS
 
+def compress_to_7z(file):
+	print("Creating 7zip container...")
+	run_tool([x7z, 'a', *x7z_options, f'{file}.7z', file])
 
-### START
 
-# Check if python-magic can be imported. Use `is_magic` to track if it succeeded.
-try:
-	import magic
-	is_magic = True
-except ImportError:
-	# TODO: Clean up error messages.
-	print("It appears python-magic is not installed.")
-	is_magic = False
-	
-	# Offer to attempt installing automatically.
-	print("Python can attempt to install the required files automatically.")
-	magic_install_choice = confirm()
+# Create a 7zip container by streaming `source` into 7zip's standard input, stored inside as `name`.
+# Nothing is written to disk except the archive itself. Returns 7zip's exit code.
+def stream_to_7z(source, archive, name) -> int:
+	from tempfile import TemporaryFile
 	
-	if magic_install_choice in accept_options:
-		# Import some extras to aid with installing.
-		from sys import executable
-		from subprocess import check_call
-		
-		try:
-			# The preferred way to use pip is through subprocess.
-			# check_call will ensure the process completes successfully before continuing.
-			# Using the system executable variable is a path to the currently running version of Python, ensuring a compatible version is installed. Works cross-platform.
-			check_call([executable, '-m', 'pip', 'install', 'python-magic'])
-			
-			# If on Windows, install the necessary binary as well.
-			if platform.startswith('win32'):
-				check_call([executable, '-m', 'pip', 'install', 'python-magic-bin==0.4.14'])
-		except:
-			print("Could not install. Please ensure pip or Python is installed to PATH and try again.")
+	print("Creating 7zip container...")
+	# 7zip's output goes to a temp file. Reading it from a pipe while writing to stdin could deadlock.
+	with TemporaryFile() as log:
+		with cpu_slot():
+			# Lack of space after switch is intentional. 7z's command line interface is bad.
+			from subprocess import PIPE, STDOUT
+			process = start_tool([x7z, 'a', *x7z_options, f'-si{name}', archive], stdin=PIPE, stdout=log, stderr=STDOUT)
+			try:
+				from shutil import copyfileobj
+				copyfileobj(source, process.stdin, stream_chunk_size)
+			except BrokenPipeError:
+				# 7zip quit early. Its exit code and output say why.
+				pass
+			finally:
+				try:
+					process.stdin.close()
+				except BrokenPipeError:
+					pass
+				wait_for_tool(process)
 		
-		try:
-			# Try importing again
-			import magic
-			is_magic = True
-		except:
-			print("Could not install. Please ensure pip is installed and try again.")
-			is_magic = False
-	else:
-		print("Please install `python-magic` with pip.")
-		if platform.endswith('win32'):
-			print("On Windows, also install the binaries for Magic with `pip3.exe install python-magic-bin==0.4.14`")
+		log.seek(0)
+		print(log.read().decode(errors='replace'), end='')
+	return process.returncode
 
 
-# Set all the executable locations because Windows is a special duck.
-# Defining these outside of a function makes them automatically global variables.
-if platform.startswith('win32'):
-	# Special extra windows junk
-	from shutil import which
-	from os import getenv
-	
-	# Install/import winreg
-	try:
-		import winreg
-	except ImportError:
-		print("Installing winreg...")
-		check_call([executable, '-m', 'pip', 'install', 'winreg'])
-	finally:
-		try:
-			import winreg
-		except ImportError:
-			print("Unable to install winreg module. Please ensure pip is installed.")	
-	
-	
-	# Get local system variables
-	localappdata = getenv("LocalAppData")
-	programfiles = getenv("ProgramFiles")  # Alternate maybe?  %ProgramW6432%
-	programfiles32 = getenv("ProgramFiles(x86)")
+# Start an external tool. Its start time is kept for --profile.
+def start_tool(args, **options):
+	from subprocess import Popen
+	from time import monotonic
 	
+	process = Popen(tools.command(args), **options)
+	process.started = monotonic()
+	return process
+
+
+# Run an external optimizer and print what it says through Python.
+# Tools write straight to the terminal otherwise, which scrambles the log when several files run at once.
+# Tools never get any input, so one that asks for something (like 7zip wanting a password) fails instead of waiting forever.
+def run_tool(args, cwd=None):
+	from subprocess import CompletedProcess, DEVNULL, PIPE, STDOUT
 	
-	# Check if installed things exist where expected.
-	def check_paths(*paths) -> str:
-		#print(paths)
-		for path in paths:
-			try:
-				# Pathlib can't handle a None type. Check before it so it is never reached.
-				# An empty path returns True. Don't want that.
-				if path != None and path != "" and Path(path).exists():
-					return path
-			except TypeError:
-				print(f"{ERROR}Pathlib is probably acting up. Please report this message.{ENDC}")
-		return None  # Redundant?
+	with cpu_slot():
+		process = start_tool(args, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT, cwd=cwd)
+		with process.stdout:
+			output = process.stdout.read()
+		wait_for_tool(process)
 	
+	if output:
+		print(output.decode(errors='replace'), end='')
+	return CompletedProcess(args, process.returncode, output)
+
+
+# Wait for a tool to finish and count its CPU time towards the file being optimized.
+# os.wait4() gives the CPU time of that one process, which stays right even when other threads are running tools at the same time.
+def wait_for_tool(process, usage=None):
+	usage = usage or current_tool_usage()
+	cpu_time = 0.0
+	# Block I/O counts are in 512 byte units. Reads served from the page cache don't count.
+	read = written = 0
 	
-	# Attempt to find where a program is installed through the registry.
-	def check_registry_location(program) -> str:
+	if hasattr(os, 'wait4'):
 		try:
-			regkey = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, fr"SOFTWARE\Microsoft\Windows\CurrentVersion\App Paths\{program}")
-			return winreg.QueryValue(regkey, None)
-		except FileNotFoundError:
-			return ""  # NoneType will cause errors in pathlib. Use empty string instead.
-	
+			_, status, rusage = os.wait4(process.pid, 0)
+			process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+			cpu_time = rusage.ru_utime + rusage.ru_stime
+			read, written = rusage.ru_inblock * 512, rusage.ru_oublock * 512
+		except ChildProcessError:
+			# Something else already collected it, such as Popen.kill() checking on it first.
+			process.wait()
+	else:
+		# Windows has no wait4(). Tool names are still recorded, without their CPU time.
+		process.wait()
 	
-	# Find if programs exist on the system path or expected default locations, then add them.
-	x7zip = check_paths(
-		# 7zFM.exe may be registered, but not 7z.exe. They're likely in the same directory.
-		check_registry_location("7zFM.exe").replace("7zFM.exe", "7z.exe"),
-		which("7z.exe"), 
-		f"{programfiles}\\7-Zip\\7z.exe",
-		f"{localappdata}\\7-Zip\\7z.exe",
-		f"{programfiles32}\\7-Zip\\7z.exe"
-	)
-	
-	flac = check_paths(
-		which('flac.exe'),	
-		#check_registry_location('flac.exe'),
-		f"{programfiles}\\flac\\win64\\flac.exe", 
-		f"{localappdata}\\flac\\win64\\flac.exe",
-		f"{programfiles32}\\flac\\win32\\flac.exe"
-	)
-	jpegoptim = check_paths(
-		which('jpegoptim.exe'), 
-		#check_registry_location('jpegoptim.exe'),
-		f"{programfiles}\\jpegoptim\\jpegoptim.exe", 
-		f"{localappdata}\\jpegoptim\\jpegoptim.exe",
-		f"{programfiles32}\\flac\\bin\\flac.exe"
-	)
-	optipng = check_paths(
-		which('optipng.exe'), 
-		#check_registry_location('optipng.exe'),
-		f"{programfiles32}\\optipng\\optipng.exe", 
-		f"{programfiles}\\optipng\\optipng.exe", 
-		f"{localappdata}\\optipng\\optipng.exe"
-	)
-	advpng = check_paths(
-		which('advpng.exe'), 
-		#check_registry_location('advpng.exe'),
-		f"{programfiles}\\advancecomp\\advpng.exe", 
-		f"{localappdata}\\advancecomp\\advpng.exe",
-		f"{programfiles32}\\flac\\bin\\flac.exe"
-	)
-	cwebp = check_paths(
-		which('cwebp.exe'), 
-		#check_registry_location('cwebp.exe'),
-		f"{programfiles}\\libwebp\\bin\\cwebp.exe", 
-		f"{localappdata}\\libwebp\\bin\\cwebp.exe",
-		f"{programfiles32}\\flac\\bin\\flac.exe"
-	)
-	advzip = check_paths(
-		which('advzip.exe'), 
-		#check_registry_location('advzip.exe'),
-		f"{programfiles}\\advancecomp\\advzip.exe", 
-		f"{localappdata}\\advancecomp\\advzip.exe",
-		f"{programfiles32}\\flac\\bin\\flac.exe" 
-	)
-else:
-	# Every other system is nice and simple.
-	x7z = '7z'
-	flac = 'flac'
-	jpegoptim = 'jpegoptim'
-	optipng = 'optipng'
-	advpng = 'advpng'
-	cwebp = 'cwebp'
-	advzip = 'advzip'
-
-
-
-def get_mimetype(file) -> str:
-	# Check if magic-python imported successfully.
-	if is_magic == True:
-		# Check if input is a file or directory before passing to magic.
-		# python-magic will fail if given a directory.
-		if Path(file).is_dir():
-			type = 'inode/directory'
-		else:
-			# *~ M a g i c ~*
-			try:
-				# Get the mime-type from a file using magic.
-				type = magic.from_file(file, mime=True)
-			except IsADirectoryError:
-				# This should be redundant with the above if statement, but it's here just in case to catch.
-				type = 'inode/directory'
+	if usage is not None:
+		usage.add(Path(process.args[0]).name, cpu_time)
+	if hasattr(process, 'started') and current_profiler() is not None:
+		from time import monotonic
+		wall_time = monotonic() - process.started
+		# The stage that started the tool was waiting on it the whole time.
+		stages = getattr(profile_stack, 'stages', None)
+		if stages:
+			stages[-1][2] += wall_time
+		record_stage(f'tool {Path(process.args[0]).name}', wall_time, cpu_time, read, written, usage)
+	return process.returncode
 
-	elif is_magic == False:
-		if platform.startswith('linux'):
-			print("Falling back to using native `file` command to detect mime-type.")
+
+# Which tools ran for a file and how much CPU time they used.
+class ToolUsage:
+	def __init__(self):
+		self.tools = []
+		self.cpu_time = 0.0
+		# CPU time of each tool, for the benchmark's breakdown.
+		self.tool_times = {}
+		# Stages timed for --profile: (stage, wall time, CPU time, bytes read, bytes written).
+		self.stages = []
+		self.lock = threading.Lock()
+
+	def add(self, tool, cpu_time):
+		with self.lock:
+			if tool not in self.tools:
+				self.tools.append(tool)
+			self.cpu_time += cpu_time
+			self.tool_times[tool] = self.tool_times.get(tool, 0.0) + cpu_time
+
+	# Count another record's tools as part of this one, such as for files optimized inside an archive.
+	def merge(self, other):
+		for tool, cpu_time in list(other.tool_times.items()):
+			self.add(tool, cpu_time)
+
+
+# The ToolUsage of the file each thread is working on. Threads started for one file are handed it directly.
+tool_usage = threading.local()
+
+def current_tool_usage():
+	return getattr(tool_usage, 'current', None)
+
+
+# Wrap `function` to run in a helper thread on behalf of the file this thread is working on.
+# The wrapper returns what it printed along with its value, so it can be printed with that file's log.
+# Its tools count towards the file, and it works for the same Optimizer.
+def for_file(function):
+	usage = current_tool_usage()
+	optimizer = current_optimizer()
+	
+	def run(*args, **kwargs):
+		start_buffer()
+		tool_usage.current = usage
+		optimizer_context.optimizer = optimizer
+		try:
+			value = function(*args, **kwargs)
+		finally:
+			tool_usage.current = None
+			optimizer_context.optimizer = None
+			log = end_buffer()
+		return log, value
+	return run
+
+
+# What happened to one file.
+# status is one of: optimized, unchanged, skipped, cached (already optimized by an earlier run), prescreened (predicted to gain less than --min-gain),
+# duplicate (given the result of another file with the same contents), failed, or queued (waiting for a --batch).
+# A plain class rather than a dataclass. Importing dataclasses costs more than everything else at startup.
+class Result:
+	# Everything that goes in the report, in order.
+	fields = ('path', 'type', 'status', 'original_size', 'final_size', 'output', 'tools', 'wall_time', 'cpu_time', 'tool_times', 'message')
+
+	def __init__(self, path, type=None, status='skipped', original_size=0, final_size=0, output=None, tools=None,
+			wall_time=0.0, cpu_time=0.0, tool_times=None, message='', batch_results=None):
+		self.path = path
+		self.type = type
+		self.status = status
+		self.original_size = original_size
+		self.final_size = final_size
+		# Where the file ended up. Differs from `path` when it was converted to another format.
+		self.output = output
+		self.tools = tools or []
+		self.wall_time = wall_time
+		self.cpu_time = cpu_time
+		# CPU seconds spent in each tool.
+		self.tool_times = tool_times or {}
+		self.message = message
+		# Results of a whole --batch that this file happened to complete. Not part of the report line for this file.
+		self.batch_results = batch_results or []
+
+	def __repr__(self):
+		return f"Result({', '.join(f'{name}={getattr(self, name)!r}' for name in self.fields)})"
+
+	@property
+	def saved(self) -> int:
+		return self.original_size - self.final_size
+
+	def as_dict(self) -> dict:
+		return {**{name: getattr(self, name) for name in self.fields}, 'tools': list(self.tools), 'tool_times': dict(self.tool_times), 'saved': self.saved}
+
+
+# Collects results as files finish. Writes each one as a line of JSON to `report_file`, if given, and totals everything for the summary.
+# Only used from the main thread.
+class Reporter:
+	def __init__(self, report_file=None):
+		from time import monotonic
+		
+		self.report = open(report_file, 'w', encoding='utf-8') if report_file else None
+		self.started = monotonic()
+		self.statuses = {}
+		self.files = 0
+		self.bytes_in = 0
+		self.bytes_saved = 0
+		self.cpu_time = 0.0
+		self.tool_times = {}
+
+	def add(self, result):
+		import json
+		
+		# Queued files are reported when their batch finishes.
+		if result is None or result.status == 'queued':
+			return
+		
+		self.files += 1
+		self.statuses[result.status] = self.statuses.get(result.status, 0) + 1
+		self.bytes_in += result.original_size
+		self.bytes_saved += max(result.saved, 0)
+		self.cpu_time += result.cpu_time
+		for tool, cpu_time in result.tool_times.items():
+			self.tool_times[tool] = self.tool_times.get(tool, 0.0) + cpu_time
+		
+		if self.report is not None:
+			# Flushed after every file so the report can be followed while the run is going.
+			self.report.write(json.dumps(result.as_dict(), default=str) + '\n')
+			self.report.flush()
+
+	def summary(self) -> dict:
+		from time import monotonic
+		
+		elapsed = monotonic() - self.started
+		return {
+			'files': self.files,
+			'statuses': self.statuses,
+			'bytes_in': self.bytes_in,
+			'bytes_saved': self.bytes_saved,
+			'wall_time': elapsed,
+			'cpu_time': self.cpu_time,
+			'tool_times': dict(self.tool_times),
+			'files_per_second': self.files / elapsed if elapsed else 0.0,
+			'mb_per_second': self.bytes_in / 1024 ** 2 / elapsed if elapsed else 0.0,
+		}
+
+	def close(self):
+		import json
+		
+		summary = self.summary()
+		if self.report is not None:
+			self.report.write(json.dumps({'summary': summary}) + '\n')
+			self.report.close()
+		
+		statuses = ', '.join(f'{count} {status}' for status, count in sorted(summary['statuses'].items()))
+		print(f"\nProcessed {summary['files']} files ({statuses or 'none'}) in {summary['wall_time']:.1f} seconds.")
+		if summary['files']:
+			print(f"Saved {summary['bytes_saved']} of {summary['bytes_in']} bytes ({summary['bytes_saved'] / max(summary['bytes_in'], 1):.2%}).")
+			print(f"{summary['files_per_second']:.2f} files/s, {summary['mb_per_second']:.2f} MB/s, {summary['cpu_time']:.1f} seconds of tool CPU time.")
+
+
+# Adds up where the time goes for --profile, per stage of optimizing a file and per mime-type.
+# Stages are detect, pre-check, hash, compare, commit, and `tool <name>` for each external tool.
+# Wall time is each stage's own, without the stages inside it. CPU time is this process's thread for Python stages, and the tool's own for tools.
+# Every stage is also handed to each of `hooks` as a dict, from whichever thread finished the file, so the numbers can go elsewhere too.
+class Profiler:
+	columns = ('wall_time', 'cpu_time', 'bytes_read', 'bytes_written')
+
+	def __init__(self, hooks=()):
+		self.hooks = list(hooks)
+		self.stages = {}
+		self.types = {}
+		self.lock = threading.Lock()
+
+	# `stages` are (stage, wall time, CPU time, bytes read, bytes written) from one file, or from a batch of `files` files.
+	# A stage entered more than once for a file, such as a tool run several times, is added up into one.
+	def add(self, type, path, stages, files=1):
+		type = type or 'unknown'
+		records = {}
+		for stage, *numbers in stages:
+			record = records.setdefault(stage, {'stage': stage, **dict.fromkeys(self.columns, 0), 'type': type, 'path': path})
+			for column, number in zip(self.columns, numbers):
+				record[column] += number
+		records = list(records.values())
+		
+		with self.lock:
+			self.types.setdefault(type, dict.fromkeys(('files', *self.columns), 0))['files'] += files
+			for record in records:
+				totals = self.stages.setdefault(record['stage'], dict.fromkeys(('files', *self.columns), 0))
+				totals['files'] += 1
+				for column in self.columns:
+					totals[column] += record[column]
+					self.types[type][column] += record[column]
+			hooks = list(self.hooks)
+		
+		for hook in hooks:
+			try:
+				for record in records:
+					hook(record)
+			except Exception as error:
+				# Losing the export shouldn't lose the run.
+				print(f"{WARNING}Profile hook {getattr(hook, '__name__', hook)} failed and was turned off: {error}{ENDC}")
+				with self.lock:
+					if hook in self.hooks:
+						self.hooks.remove(hook)
+
+	def summary(self) -> dict:
+		with self.lock:
+			return {
+				'stages': {stage: dict(totals) for stage, totals in self.stages.items()},
+				'types': {type: dict(totals) for type, totals in self.types.items()},
+			}
+
+	def print_table(self):
+		summary = self.summary()
+		total = sum(totals['wall_time'] for totals in summary['stages'].values()) or 1.0
+		
+		def row(name, totals):
+			return (f"{name[:40]:40} {totals['files']:>6} {totals['wall_time']:>9.2f}s {totals['cpu_time']:>9.2f}s "
+				f"{totals['bytes_read'] / 1024 ** 2:>9.1f}MB {totals['bytes_written'] / 1024 ** 2:>9.1f}MB")
+		
+		print(f"\n{OKGREEN}Time per stage:{ENDC}")
+		print(f"{'stage':40} {'files':>6} {'wall':>10} {'cpu':>10} {'read':>11} {'written':>11}")
+		for stage, totals in sorted(summary['stages'].items(), key=lambda item: -item[1]['wall_time']):
+			print(row(stage, totals) + f" {totals['wall_time'] / total:>6.1%}")
+		
+		print(f"\n{OKGREEN}Time per mime-type:{ENDC}")
+		print(f"{'mime-type':40} {'files':>6} {'wall':>10} {'cpu':>10} {'read':>11} {'written':>11}")
+		for type, totals in sorted(summary['types'].items(), key=lambda item: -item[1]['wall_time']):
+			print(row(type, totals))
+		print("Tools running side by side each count their own wall time, so stages can add up to more than the run took.")
+
+
+# What each thread is printing, while it collects it. Workers collect each file's log so it can be printed in one piece when it is done.
+# Everything in this script prints through the print() below, so sys.stdout is never replaced. Programs using it keep their own output.
+output_buffers = threading.local()
+
+def start_buffer():
+	output_buffers.buffer = StringIO()
+
+def end_buffer() -> str:
+	text = output_buffers.buffer.getvalue()
+	output_buffers.buffer = None
+	return text
+
+def print(*args, **kwargs):
+	buffer = getattr(output_buffers, 'buffer', None)
+	if buffer is not None and kwargs.get('file') is None:
+		kwargs['file'] = buffer
+	builtins.print(*args, **kwargs)
+
+
+# Files with the same name but different extensions can end up with the same new name (`song.wav` and `song.flac` both become `song.flac`).
+# Only let one of them be worked on at a time so keep_smaller_file never races another job for it.
+# A fixed set of locks is shared by hashing the name, so huge runs don't keep one lock per file around.
+stem_locks = [threading.Lock() for _ in range(256)]
+
+def stem_lock(file) -> threading.Lock:
+	stem = Path(file).absolute().with_suffix('')
+	return stem_locks[hash(stem) % len(stem_locks)]
+
+
+# How many characters of arguments can be passed to a program at once.
+# Half the system limit leaves room for the environment and the tool's own options.
+def argument_limit() -> int:
+	if platform.startswith('win32'):
+		# CreateProcess allows 32767 characters for the whole command line.
+		return 30000
+	try:
+		return max(4096, os.sysconf('SC_ARG_MAX') // 2)
+	except (AttributeError, ValueError, OSError):
+		return 4096
+
+
+# Bytes from a size like 512M or 8G. Suffixes are powers of 1024.
+def parse_size(text) -> int:
+	units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+	text = text.strip().lower()
+	if text.endswith('b'):
+		text = text[:-1]
+	if text and text[-1] in units:
+		return int(float(text[:-1]) * units[text[-1]])
+	return int(text)
+
+
+# Find the function named by --profile-hook, such as "mymetrics:record", which is module:function.
+# The module is imported the usual way, so it can be anywhere on the Python path, including the current directory.
+def load_profile_hook(spec):
+	from argparse import ArgumentTypeError
+	from importlib import import_module
+	
+	module, _, name = spec.partition(':')
+	if not module or not name:
+		raise ArgumentTypeError(f"{spec} should be module:function")
+	if '' not in sys.path:
+		sys.path.append('')
+	try:
+		hook = getattr(import_module(module), name)
+	except (ImportError, AttributeError) as error:
+		raise ArgumentTypeError(f"can't load {spec}: {error}")
+	if not callable(hook):
+		raise ArgumentTypeError(f"{spec} is not a function")
+	return hook
+
+
+# Gathers files of the same kind until there are enough to hand a tool all at once.
+# add() returns a full chunk of (file, mime-type) pairs for the caller to optimize, or None while the chunk is still filling.
+class Batcher:
+	def __init__(self, max_files=100, max_length=None):
+		self.max_files = max_files
+		self.max_length = max_length or argument_limit()
+		self.pending = {}
+		self.lock = threading.Lock()
+
+	def add(self, kind, file, type=None):
+		with self.lock:
+			files, length = self.pending.get(kind, ([], 0))
+			files.append((file, type))
+			# Each argument also costs a pointer and a terminating null.
+			length += len(os.fsencode(file)) + 9
+			
+			if len(files) >= self.max_files or length >= self.max_length:
+				del self.pending[kind]
+				return files
+			
+			self.pending[kind] = (files, length)
+			return None
+
+	# Hand back every chunk that is still filling up. Used once there are no more files coming.
+	def drain(self) -> list:
+		with self.lock:
+			chunks = [(kind, files) for kind, (files, _) in self.pending.items()]
+			self.pending.clear()
+			return chunks
+
+
+# Finds files with the same contents so only one of each is optimized. The result is then given to the others.
+# Files are grouped by size first, so only files that share their size with another are ever hashed.
+# Every file has to be seen before any can be told apart from the rest, so the whole list is gathered up front.
+# With `hardlink`, the copies become links to the optimized file instead of copies of it. They then share its permissions and owner.
+class Duplicates:
+	def __init__(self, hardlink=False):
+		self.hardlink = hardlink
+		# The other files with the same contents as each file that is optimized, with their stat from when they were grouped.
+		self.copies = {}
+
+	# Yield one file of each group, in the order they came in, and hold back the rest.
+	def group(self, files):
+		from stat import S_ISREG
+		
+		files = list(files)
+		stats, sizes = {}, {}
+		for file in files:
+			try:
+				stat = os.stat(file)
+			except OSError:
+				continue
+			# Empty files have nothing to gain, and anything but a regular file is left to the optimizers.
+			if S_ISREG(stat.st_mode) and stat.st_size:
+				stats[file] = stat
+				sizes.setdefault(stat.st_size, []).append(file)
+		
+		first = {}
+		for size, group in sizes.items():
+			if len(group) < 2:
+				continue
+			# Links to the same file only need hashing once.
+			digests = {}
+			for file in group:
+				stat = stats[file]
+				try:
+					digest = digests.get((stat.st_dev, stat.st_ino)) or hash_file(file)
+				except OSError:
+					continue
+				digests[(stat.st_dev, stat.st_ino)] = digest
+				if digest in first:
+					self.copies.setdefault(str(first[digest]), []).append((file, stat))
+				else:
+					first[digest] = file
+		
+		held = {str(file) for copies in self.copies.values() for file, _ in copies}
+		for file in files:
+			if str(file) not in held:
+				yield file
+
+	# Results for the files held back because they match the file `result` is for.
+	def apply(self, result) -> list:
+		copies = self.copies.pop(result.path, [])
+		if result.status != 'optimized':
+			# Nothing to hand on. The copies would have come out the same way.
+			return [Result(str(file), type=result.type, status=result.status, original_size=stat.st_size, final_size=stat.st_size,
+				output=str(file), message=f"Same contents as {result.path}. {result.message}".strip()) for file, stat in copies]
+		return [self.apply_to(result, file, stat) for file, stat in copies]
+
+	def apply_to(self, result, file, stat) -> Result:
+		from shutil import copyfile
+		from time import monotonic
+		
+		started = monotonic()
+		copy = Result(str(file), type=result.type, original_size=stat.st_size, final_size=stat.st_size)
+		# A converted file gets the new format's extension here too.
+		source = Path(result.output)
+		target = Path(file) if source.suffix == Path(result.path).suffix else Path(file).with_suffix(source.suffix)
+		try:
+			current = os.stat(file)
+			if (current.st_size, current.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+				copy.message = "Changed during the run, so it was left alone."
+				return copy
+			if target != Path(file) and target.exists():
+				print(f"{WARNING}{target} already exists. Keeping {file} as it is.{ENDC}")
+				copy.message = f"{target} already exists."
+				return copy
+			
+			staged = target.with_name(f'.{target.name}.{os.getpid()}.tmp')
+			linked = False
+			if self.hardlink:
+				try:
+					os.link(source, staged)
+					os.replace(staged, target)
+					linked = True
+				except OSError as error:
+					discard_file(staged)
+					print(f"{WARNING}Could not link {target} to {source}, so it was copied instead. ({error}){ENDC}")
+			if not linked:
+				with io_slot():
+					copyfile(source, staged)
+				commit_file(staged, target, mode_from=stat.st_mode)
+			if target != Path(file):
+				Path(file).unlink()
+			
+			print(f"{OKGREEN}{file} has the same contents as {result.path}. Used its result.{ENDC}")
+			copy.status = 'duplicate'
+			copy.output = str(target)
+			copy.final_size = result.final_size
+			copy.message = f"Same contents as {result.path}."
+		except OSError as error:
+			print(f"{ERROR}Failed to use the result of {result.path} for {file}: {error}{ENDC}")
+			copy.status = 'failed'
+			copy.message = str(error)
+		finally:
+			copy.wall_time = monotonic() - started
+		return copy
+
+
+# Kinds of files by extension, for scheduling. Only a guess, since the real type isn't known until a file is opened.
+schedule_kinds = {
+	'.png': 'png', '.apng': 'png',
+	'.jpg': 'jpeg', '.jpeg': 'jpeg', '.jpe': 'jpeg', '.jfif': 'jpeg',
+	'.webp': 'webp',
+	'.7z': '7z',
+	'.gz': 'gzip', '.tgz': 'gzip',
+	'.zip': 'zip', '.docx': 'zip', '.xlsx': 'zip', '.pptx': 'zip', '.odt': 'zip', '.ods': 'zip', '.odp': 'zip', '.odg': 'zip', '.epub': 'zip', '.jar': 'zip', '.apk': 'zip',
+	'.wav': 'audio', '.flac': 'audio',
+}
+
+# Rough time spent per byte on each kind, relative to each other. Only the order they put files in matters.
+schedule_costs = {'png': 8, 'webp': 8, '7z': 4, 'zip': 3, 'gzip': 2, 'jpeg': 1, 'audio': 1}
+
+
+# Width times height of a PNG, from its header.
+def png_pixels(file):
+	import struct
+	
+	try:
+		with open(file, 'rb') as f:
+			header = f.read(24)
+	except OSError:
+		return None
+	if len(header) < 24 or not header.startswith(b'\x89PNG\r\n\x1a\n') or header[12:16] != b'IHDR':
+		return None
+	width, height = struct.unpack('>II', header[16:24])
+	return width * height
+
+
+# Memory 7zip's LZMA2 needs at -mx=9 for `content_size` bytes, with the dictionary x7z_tuned_options() picks.
+# Each pair of threads works on its own block of four dictionaries and needs about 11 dictionaries' worth.
+def x7z_memory(content_size) -> int:
+	dictionary = x7z_dictionary(content_size)
+	encoders = max(1, min((os.cpu_count() or 1) // 2, -(-content_size // (4 * dictionary))))
+	return encoders * 11 * dictionary
+
+
+# About how much memory optimizing a file will take, from its size and the options it will be optimized with.
+def estimate_memory(file, size, kind, options) -> int:
+	megabyte = 1024 ** 2
+	# Python's own share of a job, and tools that don't grow with the file.
+	base = 32 * megabyte
+	if kind == 'png':
+		# Every strategy runs at once, each holding a few copies of the decoded image.
+		pixels = png_pixels(file) or size * 4
+		return base + pixels * 8 * max(len(png_strategies(options.get('convert_png'), options.get('use_pngcrush'))), 1)
+	if kind == 'webp':
+		return base + size * 20
+	if kind == 'jpeg':
+		return base + size * 12
+	if kind == '7z':
+		return base + x7z_memory(size * 2)
+	if kind == 'gzip' and options.get('convert_gzip'):
+		return base + x7z_memory(size * 4)
+	if kind == 'zip':
+		# AdvZIP holds a member and its recompressed copy.
+		return base + size * 3
+	return base
+
+
+# Decides which file the pool starts next. The slowest files go first, so one big file picked up last doesn't leave a long tail with one busy core.
+# Files are looked at `window` at a time, so huge runs are never held in memory all at once.
+# With `max_memory`, a file only starts once the memory of the jobs already running leaves room for it.
+# Smaller files don't skip ahead of one waiting for room, or a steady stream of them could hold it off for good.
+# A file that could never fit starts once nothing else is running.
+class Scheduler:
+	def __init__(self, files, options, max_memory=None, window=4096):
+		self.files = iter(files)
+		self.options = options
+		self.max_memory = max_memory
+		self.window = window
+		self.waiting = []
+		self.count = 0
+
+	def fill(self):
+		import heapq
+		
+		while len(self.waiting) < self.window:
+			file = next(self.files, None)
+			if file is None:
+				return
+			try:
+				size = os.stat(file).st_size
+			except OSError:
+				# Let optimize_single_file() report it.
+				size = 0
+			kind = schedule_kinds.get(Path(file).suffix.lower())
+			memory = estimate_memory(file, size, kind, self.options) if self.max_memory is not None else 0
+			# The count keeps files of the same cost in the order they came in.
+			heapq.heappush(self.waiting, (-size * schedule_costs.get(kind, 1), self.count, file, memory))
+			self.count += 1
+
+	# The next file to start and its memory estimate, or None to wait for a running job to finish.
+	# None with nothing running means there are no files left.
+	def take(self, memory_in_use):
+		import heapq
+		
+		self.fill()
+		if not self.waiting:
+			return None
+		cost, count, file, memory = self.waiting[0]
+		if self.max_memory is not None and memory_in_use and memory_in_use + memory > self.max_memory:
+			return None
+		heapq.heappop(self.waiting)
+		if self.max_memory is not None and memory > self.max_memory:
+			print(f"{WARNING}{file} may need about {memory // 1024 ** 2} MB of memory, more than --max-memory allows. It will be optimized on its own.{ENDC}")
+		return file, memory
+
+
+# Check a path against glob patterns. Patterns match either the bare name or the path relative to where the search started.
+def matches_any(name, relative_path, patterns) -> bool:
+	from fnmatch import fnmatch
+	return any(fnmatch(name, pattern) or fnmatch(relative_path, pattern) for pattern in patterns)
+
+
+# Yield every file to be processed, one at a time, without building a list of the whole tree first.
+# Directories are walked with a stack instead of recursion so deep trees don't grow the call stack.
+# Symbolic links inside directories are never followed. Optimizing through a link would replace it with a regular file.
+def walk_files(paths, recursion=False, include=(), exclude=()):
+	for path in paths:
+		path = Path(path)
+		
+		if matches_any(path.name, path.name, exclude):
+			print(f"Skipping {path}. It matches an excluded pattern.")
+			continue
+		
+		if not path.is_dir():
+			if not include or matches_any(path.name, path.name, include):
+				yield path
+			continue
+		
+		print(f"{path} is a directory.")
+		if not recursion:
+			print(f"Skipping {path}. Use `-r` to recursively optimize files inside directories.")
+			continue
+		
+		print(f"Optimizing contents of {path}")
+		# Each level keeps its directory open while its subdirectories are searched, so huge directories are never read in one go.
+		stack = [(os.scandir(path), '')]
+		try:
+			while stack:
+				entries, relative_dir = stack[-1]
+				entry = next(entries, None)
+				if entry is None:
+					entries.close()
+					stack.pop()
+					continue
+				
+				relative_path = f'{relative_dir}{entry.name}'
+				if exclude and matches_any(entry.name, relative_path, exclude):
+					continue
+				
+				try:
+					if entry.is_symlink():
+						print(f"Skipping {entry.path}. Symbolic links are not followed.")
+					elif entry.is_dir(follow_symlinks=False):
+						stack.append((os.scandir(entry.path), f'{relative_path}/'))
+					elif entry.is_file(follow_symlinks=False):
+						if not include or matches_any(entry.name, relative_path, include):
+							yield Path(entry.path)
+				except OSError as error:
+					print(f"{WARNING}Could not read {entry.path}. ({error}){ENDC}")
+		finally:
+			# Close whatever is left open if the caller stops early.
+			for entries, _ in stack:
+				entries.close()
+
+
+# Reports files as they are written to directories, using Linux's inotify, so new files can be found without walking everything again.
+# Only directories are watched. With `recursion`, so is every directory inside them, including ones made later.
+# Files that appear inside a new directory before its watch starts are reported along with it.
+# https://man7.org/linux/man-pages/man7/inotify.7.html
+class Watcher:
+	IN_MODIFY = 0x2
+	IN_CLOSE_WRITE = 0x8
+	IN_MOVED_TO = 0x80
+	IN_CREATE = 0x100
+	IN_Q_OVERFLOW = 0x4000
+	IN_IGNORED = 0x8000
+	IN_ISDIR = 0x40000000
+	IN_NONBLOCK = 0o4000
+	IN_CLOEXEC = 0o2000000
+	
+	mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+	def __init__(self, paths, recursion=False, include=(), exclude=()):
+		import ctypes
+		import ctypes.util
+		
+		if not platform.startswith('linux'):
+			raise OSError("Watching for new files needs inotify, which only Linux has.")
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+		self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+		if self.fd < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, os.strerror(error))
+		
+		self.paths = [Path(path) for path in paths]
+		self.recursion = recursion
+		self.include = include
+		self.exclude = exclude
+		# Watched directories by watch descriptor, with their path relative to where the search started for matching patterns.
+		self.directories = {}
+		try:
+			for path in self.paths:
+				if path.is_dir():
+					self.watch(path, '')
+				else:
+					print(f"{WARNING}Skipping {path}. Only directories can be watched.{ENDC}")
+		except BaseException:
+			self.close()
+			raise
+
+	def wanted(self, name, relative_path) -> bool:
+		if self.exclude and matches_any(name, relative_path, self.exclude):
+			return False
+		return not self.include or matches_any(name, relative_path, self.include)
+
+	# Start watching a directory, and its subdirectories with recursion.
+	# Files already inside are added to `files` when given. That is for directories made while watching, whose files may have come first.
+	def watch(self, directory, relative_dir, files=None):
+		import ctypes
+		
+		descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.mask)
+		if descriptor < 0:
+			error = ctypes.get_errno()
+			if error == errno.ENOSPC:
+				print(f"{ERROR}Too many directories to watch. Raise the limit in /proc/sys/fs/inotify/max_user_watches.{ENDC}")
+			raise OSError(error, os.strerror(error), str(directory))
+		self.directories[descriptor] = (Path(directory), relative_dir)
+		
+		if not self.recursion and files is None:
+			return
+		with os.scandir(directory) as entries:
+			for entry in entries:
+				relative_path = f'{relative_dir}{entry.name}'
+				if entry.is_dir(follow_symlinks=False):
+					if self.recursion and not (self.exclude and matches_any(entry.name, relative_path, self.exclude)):
+						self.watch(entry.path, f'{relative_path}/', files)
+				elif files is not None and entry.is_file(follow_symlinks=False) and self.wanted(entry.name, relative_path):
+					files.append(Path(entry.path))
+
+	# Wait up to `timeout` seconds, or forever with None, for files to be written. Returns the files written since the last call.
+	# If the kernel dropped events because they weren't read fast enough, every file is returned, since any of them could have changed.
+	def read(self, timeout=None) -> list:
+		import select
+		import struct
+		
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return []
+		try:
+			data = os.read(self.fd, 256 * 1024)
+		except BlockingIOError:
+			return []
+		
+		files = []
+		offset = 0
+		while offset < len(data):
+			descriptor, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+			name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0'))
+			offset += 16 + length
+			
+			if mask & self.IN_Q_OVERFLOW:
+				print(f"{WARNING}Too many files changed at once to keep track of. Looking through every watched directory again.{ENDC}")
+				return list(walk_files(self.paths, recursion=self.recursion, include=self.include, exclude=self.exclude))
+			if mask & self.IN_IGNORED:
+				# The directory is gone.
+				self.directories.pop(descriptor, None)
+				continue
+			if descriptor not in self.directories:
+				continue
+			
+			directory, relative_dir = self.directories[descriptor]
+			relative_path = f'{relative_dir}{name}'
+			if mask & self.IN_ISDIR:
+				if self.recursion and mask & (self.IN_CREATE | self.IN_MOVED_TO) and not (self.exclude and matches_any(name, relative_path, self.exclude)):
+					try:
+						self.watch(directory / name, f'{relative_path}/', files)
+					except OSError as error:
+						print(f"{WARNING}Could not watch {directory / name}. ({error}){ENDC}")
+			elif mask & (self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO) and self.wanted(name, relative_path):
+				files.append(directory / name)
+		return files
+
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd = -1
+
+
+# Fingerprint a file's contents. BLAKE2 is faster than SHA-256 and is in the standard library.
+# Takes a path, or something already open to read from, like FileInfo.reader().
+def hash_file(file) -> str:
+	import hashlib
+	
+	digest = hashlib.blake2b(digest_size=20)
+	with profiled('hash'), io_slot(), (nullcontext(file) if hasattr(file, 'read') else open(file, 'rb')) as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b''):
+			digest.update(chunk)
+			profile_bytes(read=len(chunk))
+	return digest.hexdigest()
+
+
+# The file a thread is optimizing, opened once. Detection, pre-screening and hashing all read from the same handle,
+# through a memory map where the filesystem allows one, and its stat() is taken once and kept for comparing results later.
+# close() lets go of the file before any tool runs, since Windows won't replace a file that is open. The kept stat stays usable.
+class FileInfo:
+	def __init__(self, file):
+		import mmap
+		
+		self.path = Path(file)
+		self.file = open(file, 'rb')
+		self.stat = os.fstat(self.file.fileno())
+		self.size = self.stat.st_size
+		self.digest = None
+		self.data = None
+		try:
+			# Empty files can't be mapped.
+			if self.size:
+				self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		except (OSError, ValueError):
+			# Neither can files on some network filesystems. Reads go through the file instead.
+			pass
+
+	def header(self, size=512) -> bytes:
+		if self.data is not None:
+			return self.data[:size]
+		self.file.seek(0)
+		return self.file.read(size)
+
+	# Something to read the whole file from, rewound to the start. Seeking around in it is fine.
+	def reader(self):
+		source = self.data if self.data is not None else self.file
+		source.seek(0)
+		return source
+
+	# The open file itself, rewound, for readers like zipfile that need a real file object.
+	def handle(self):
+		self.file.seek(0)
+		return self.file
+
+	def hash(self) -> str:
+		if self.digest is None:
+			self.digest = hash_file(self.reader())
+		return self.digest
+
+	def close(self):
+		if self.data is not None:
+			self.data.close()
+			self.data = None
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+
+# The FileInfo for the file each thread is working on, so the size taken when it was opened is used when results are compared.
+file_info = threading.local()
+
+def current_file_info(file=None):
+	info = getattr(file_info, 'current', None)
+	if info is not None and (file is None or info.path == Path(file)):
+		return info
+	return None
+
+
+# Where results and statistics are remembered between runs.
+def data_dir() -> Path:
+	if platform.startswith('win32'):
+		cache_dir = os.getenv('LocalAppData') or Path.home()
+	else:
+		cache_dir = os.getenv('XDG_CACHE_HOME') or Path.home() / '.cache'
+	return Path(cache_dir, 'optpymize')
+
+
+def default_cache_file() -> Path:
+	return data_dir() / 'results.sqlite'
+
+
+def default_stats_file() -> Path:
+	return data_dir() / 'stats.sqlite'
+
+
+# Where a run over `roots` keeps its journal unless it is given one. Runs over other files, or with other options, get their own,
+# so one never starts over the journal of another, such as a nightly run's while a single file is optimized on the side.
+def default_journal_file(roots, options) -> Path:
+	import hashlib
+	
+	key = '\0'.join([*(os.path.abspath(root) for root in roots), *(f'{key}={value}' for key, value in sorted(options.items()))])
+	return data_dir() / 'journals' / f'{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}.sqlite'
+
+
+# Remembers the hashes of files that have already been optimized so re-runs can skip them without running any tools.
+# Results only count for the same options. A PNG optimized normally is not "done" if it should have been converted to WebP.
+class ResultCache:
+	def __init__(self, cache_file, options, max_entries=100000):
+		import sqlite3
+		
+		Path(cache_file).parent.mkdir(parents=True, exist_ok=True)
+		# Worker threads share one connection. The lock keeps them from using it at the same time.
+		self.db = sqlite3.connect(str(cache_file), check_same_thread=False)
+		self.lock = threading.Lock()
+		self.max_entries = max_entries
+		self.options = ','.join(f'{key}={value}' for key, value in sorted(options.items()))
+		
+		with self.lock, self.db:
+			# Write-ahead logging keeps a commit per file cheap.
+			self.db.execute('PRAGMA journal_mode=WAL')
+			self.db.execute('PRAGMA synchronous=NORMAL')
+			self.db.execute('CREATE TABLE IF NOT EXISTS optimized (key TEXT PRIMARY KEY, last_used REAL NOT NULL)')
+			self.db.execute('CREATE INDEX IF NOT EXISTS optimized_last_used ON optimized (last_used)')
+			self.entries = self.db.execute('SELECT COUNT(*) FROM optimized').fetchone()[0]
+
+	def key(self, digest) -> str:
+		return f'{digest}:{self.options}'
+
+	def is_optimized(self, digest) -> bool:
+		from time import time
+		with self.lock, self.db:
+			# Touch the entry so recently seen files are the last to be evicted.
+			return self.db.execute('UPDATE optimized SET last_used = ? WHERE key = ?', (time(), self.key(digest))).rowcount > 0
+
+	def add(self, digest):
+		from time import time
+		with self.lock, self.db:
+			if self.db.execute('UPDATE optimized SET last_used = ? WHERE key = ?', (time(), self.key(digest))).rowcount == 0:
+				self.db.execute('INSERT INTO optimized VALUES (?, ?)', (self.key(digest), time()))
+				self.entries += 1
+			
+			# Forget the least recently used files once the cache is full.
+			if self.entries > self.max_entries:
+				excess = self.entries - self.max_entries
+				self.db.execute('DELETE FROM optimized WHERE key IN (SELECT key FROM optimized ORDER BY last_used LIMIT ?)', (excess,))
+				self.entries -= excess
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+
+# Records every file as it finishes so an interrupted run can be resumed without starting over.
+# A file counts as finished while its size and modification time are what they were when it was done.
+# Starting a run without `resume` begins a new journal.
+class Journal:
+	def __init__(self, journal_file, options, resume=False):
+		import sqlite3
+		
+		Path(journal_file).parent.mkdir(parents=True, exist_ok=True)
+		self.journal_file = journal_file
+		self.db = sqlite3.connect(str(journal_file), check_same_thread=False)
+		self.lock = threading.Lock()
+		self.resume = resume
+		self.resumed = 0
+		options = ','.join(f'{key}={value}' for key, value in sorted(options.items()))
+		
+		with self.lock, self.db:
+			# Each file is committed as it finishes. Without a sync per commit this stays cheap, and still survives the process being killed.
+			self.db.execute('PRAGMA journal_mode=WAL')
+			self.db.execute('PRAGMA synchronous=NORMAL')
+			self.db.execute('CREATE TABLE IF NOT EXISTS run (options TEXT)')
+			self.db.execute('CREATE TABLE IF NOT EXISTS finished (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, status TEXT NOT NULL)')
+			
+			if resume:
+				row = self.db.execute('SELECT options FROM run').fetchone()
+				if row is not None and row[0] != options:
+					print(f"{WARNING}The run being resumed used different options. Files it finished will not be optimized again with the new ones.{ENDC}")
+			else:
+				self.db.execute('DELETE FROM run')
+				self.db.execute('DELETE FROM finished')
+				self.db.execute('INSERT INTO run VALUES (?)', (options,))
+
+	# Lookups are by primary key, so checking a file costs the same however long the journal has grown.
+	def is_finished(self, file) -> bool:
+		if not self.resume:
+			return False
+		try:
+			stat = os.stat(file)
+		except OSError:
+			return False
+		with self.lock:
+			row = self.db.execute('SELECT mtime, size FROM finished WHERE path = ? AND status != ?', (os.path.abspath(file), 'failed')).fetchone()
+		if row is None or row != (stat.st_mtime_ns, stat.st_size):
+			return False
+		self.resumed += 1
+		return True
+
+	def add(self, result):
+		# Queued files are not done until their batch is.
+		if result is None or result.status == 'queued':
+			return
+		
+		# Files optimized in place are recorded as they are now, so the next check sees them unchanged.
+		try:
+			stat = os.stat(result.path)
+			mtime, size = stat.st_mtime_ns, stat.st_size
+		except OSError:
+			mtime = size = None
+		with self.lock, self.db:
+			self.db.execute('INSERT INTO finished VALUES (?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET mtime = excluded.mtime, size = excluded.size, status = excluded.status',
+				(os.path.abspath(result.path), mtime, size, result.status))
+
+	# With `remove`, the journal is deleted. A run that finished has nothing left to resume.
+	def close(self, remove=False):
+		if self.resumed:
+			print(f"Skipped {self.resumed} files finished by the interrupted run.")
+		with self.lock:
+			self.db.close()
+		if remove:
+			for suffix in ('', '-wal', '-shm'):
+				discard_file(f'{self.journal_file}{suffix}')
+
+# Shares the work of one run between several processes, on one machine or on several machines using the same storage.
+# Each process claims a few files at a time with a lease, and keeps renewing the leases on the files it is still working on.
+# Files whose lease runs out, because the process holding them crashed or lost the storage, are claimed again by another one.
+# The first process given files walks them into the manifest, in chunks so the others can start right away. The others need no files.
+# Paths are stored in full, so every machine must see the storage at the same path, and their clocks must agree to well within a lease.
+class Manifest:
+	# Files that have taken down this many workers are given up on.
+	max_attempts = 3
+
+	def __init__(self, manifest_file, options, lease_time=300.0):
+		import socket
+		import sqlite3
+		from time import time
+		
+		Path(manifest_file).parent.mkdir(parents=True, exist_ok=True)
+		# Transactions are started by hand, so claims can take the write lock up front.
+		# No WAL: it needs shared memory, which processes on different machines don't have.
+		self.db = sqlite3.connect(str(manifest_file), timeout=60, isolation_level=None, check_same_thread=False)
+		self.lock = threading.Lock()
+		self.lease_time = lease_time
+		self.owner = f'{socket.gethostname()}:{os.getpid()}:{os.urandom(4).hex()}'
+		self.stopped = threading.Event()
+		self.renewer = None
+		options = ','.join(f'{key}={value}' for key, value in sorted(options.items()))
+		
+		with self.transaction() as db:
+			db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+			db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, state TEXT NOT NULL DEFAULT \'pending\', owner TEXT, expires REAL, attempts INTEGER NOT NULL DEFAULT 0, finished REAL, result TEXT)')
+			db.execute('CREATE INDEX IF NOT EXISTS files_state ON files (state, expires)')
+			db.execute('INSERT OR IGNORE INTO meta VALUES (\'options\', ?), (\'started\', ?)', (options, time()))
+			if self.meta(db, 'options') != options:
+				print(f"{WARNING}The manifest was started with different options. This process will use its own.{ENDC}")
+
+	@contextmanager
+	def transaction(self):
+		with self.lock:
+			self.db.execute('BEGIN IMMEDIATE')
+			try:
+				yield self.db
+			except BaseException:
+				self.db.execute('ROLLBACK')
+				raise
+			self.db.execute('COMMIT')
+
+	@staticmethod
+	def meta(db, key):
+		row = db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+		return None if row is None else row[0]
+
+	# Remember what to walk to fill the manifest. Only the first list given counts.
+	def add_source(self, paths, recursion=False, include=(), exclude=()):
+		import json
+		
+		source = json.dumps({'paths': [os.path.abspath(path) for path in paths], 'recursion': recursion, 'include': list(include), 'exclude': list(exclude)})
+		with self.transaction() as db:
+			db.execute('INSERT OR IGNORE INTO meta VALUES (\'source\', ?)', (source,))
+			if self.meta(db, 'source') != source:
+				print(f"{WARNING}The manifest already has its list of files. The files given here are ignored.{ENDC}")
+
+	# Walk the files into the manifest, if no other process is doing it. Yields after each chunk so the walker can work on files too.
+	# A process that stops part way loses the job when its lease runs out. The next one starts the walk over, skipping files already in.
+	def fill(self, chunk_size=500):
+		import json
+		from time import time
+		
+		with self.transaction() as db:
+			source = self.meta(db, 'source')
+			filler, expires = self.meta(db, 'filler'), float(self.meta(db, 'filler_expires') or 0)
+			if self.meta(db, 'filled') or source is None or (filler not in (None, self.owner) and expires > time()):
+				return
+			db.execute('INSERT OR REPLACE INTO meta VALUES (\'filler\', ?), (\'filler_expires\', ?)', (self.owner, time() + self.lease_time))
+		
+		source = json.loads(source)
+		print("Adding files to the manifest.")
+		chunk = []
+		for file in walk_files(source['paths'], recursion=source['recursion'], include=source['include'], exclude=source['exclude']):
+			chunk.append((os.path.abspath(file),))
+			if len(chunk) >= chunk_size:
+				self.insert(chunk)
+				chunk = []
+				yield
+		self.insert(chunk, filled=True)
+		yield
+
+	def insert(self, chunk, filled=False):
+		from time import time
+		
+		with self.transaction() as db:
+			db.executemany('INSERT OR IGNORE INTO files (path) VALUES (?)', chunk)
+			db.execute('UPDATE meta SET value = ? WHERE key = \'filler_expires\'', (time() + self.lease_time,))
+			if filled:
+				db.execute('INSERT OR IGNORE INTO meta VALUES (\'filled\', \'1\')')
+
+	# Lease up to `count` files that nobody is working on.
+	def claim(self, count) -> list:
+		import json
+		from time import time
+		
+		now = time()
+		with self.transaction() as db:
+			gone = db.execute('UPDATE files SET state = \'failed\', result = ? WHERE state = \'leased\' AND expires < ? AND attempts >= ?',
+				(json.dumps({'status': 'failed', 'message': f"Stopped {self.max_attempts} workers without finishing."}), now, self.max_attempts)).rowcount
+			rows = db.execute('SELECT path, state FROM files WHERE state = \'pending\' OR (state = \'leased\' AND expires < ?) LIMIT ?', (now, count)).fetchall()
+			db.executemany('UPDATE files SET state = \'leased\', owner = ?, expires = ?, attempts = attempts + 1 WHERE path = ?',
+				[(self.owner, now + self.lease_time, path) for path, state in rows])
+		
+		if gone:
+			print(f"{ERROR}Gave up on {gone} files that every worker stopped responding on.{ENDC}")
+		reclaimed = sum(1 for path, state in rows if state == 'leased')
+		if reclaimed:
+			print(f"{WARNING}Took over {reclaimed} files from a worker that stopped responding.{ENDC}")
+		return [Path(path) for path, state in rows]
+
+	# Yield files for this process to optimize until the manifest is done.
+	# Waits while other processes still hold leases, in case they crash and their files need taking over.
+	def claimed(self, count=1):
+		from time import sleep
+		
+		self.start_renewing()
+		waiting = False
+		while True:
+			for _ in self.fill():
+				yield from self.claim(count)
+			
+			files = self.claim(count)
+			if files:
+				waiting = False
+				yield from files
+				continue
+			
+			with self.lock:
+				filled = self.meta(self.db, 'filled')
+				busy = self.db.execute('SELECT 1 FROM files WHERE state = \'leased\' AND owner != ? LIMIT 1', (self.owner,)).fetchone()
+			if filled and not busy:
+				return
+			if not waiting:
+				print("Waiting for other workers." if filled else "Waiting for files to be added to the manifest.")
+				waiting = True
+			sleep(min(self.lease_time / 10, 2))
+
+	def finish(self, result):
+		import json
+		from time import time
+		
+		if result is None or result.status == 'queued':
+			return
+		with self.transaction() as db:
+			owner = db.execute('SELECT owner FROM files WHERE path = ?', (os.path.abspath(result.path),)).fetchone()
+			db.execute('UPDATE files SET state = ?, owner = ?, finished = ?, result = ? WHERE path = ?',
+				('failed' if result.status == 'failed' else 'done', self.owner, time(), json.dumps(result.as_dict(), default=str), os.path.abspath(result.path)))
+		if owner is not None and owner[0] != self.owner:
+			print(f"{WARNING}{result.path} was taken over by another worker while this one was optimizing it.{ENDC}")
+
+	# Keep the leases of files still being worked on, and of the walk, from running out.
+	def start_renewing(self):
+		from time import time
+		
+		def renew():
+			while not self.stopped.wait(self.lease_time / 3):
+				with self.transaction() as db:
+					db.execute('UPDATE files SET expires = ? WHERE owner = ? AND state = \'leased\'', (time() + self.lease_time, self.owner))
+					if self.meta(db, 'filler') == self.owner:
+						db.execute('UPDATE meta SET value = ? WHERE key = \'filler_expires\'', (time() + self.lease_time,))
+		
+		if self.renewer is None:
+			self.renewer = threading.Thread(target=renew, daemon=True)
+			self.renewer.start()
+
+	# Totals for every file finished so far by any process.
+	def summary(self) -> dict:
+		import json
+		
+		summary = {'files': 0, 'statuses': {}, 'bytes_in': 0, 'bytes_saved': 0, 'cpu_time': 0.0, 'tool_times': {}}
+		with self.lock:
+			started = float(self.meta(self.db, 'started'))
+			rows = self.db.execute('SELECT result, finished, owner FROM files WHERE result IS NOT NULL').fetchall()
+			remaining = self.db.execute('SELECT count(*) FROM files WHERE state NOT IN (\'done\', \'failed\')').fetchone()[0]
+		for result, finished, owner in rows:
+			result = json.loads(result)
+			summary['files'] += 1
+			summary['statuses'][result['status']] = summary['statuses'].get(result['status'], 0) + 1
+			summary['bytes_in'] += result.get('original_size', 0)
+			summary['bytes_saved'] += max(result.get('saved', 0), 0)
+			summary['cpu_time'] += result.get('cpu_time', 0.0)
+			for tool, cpu_time in result.get('tool_times', {}).items():
+				summary['tool_times'][tool] = summary['tool_times'].get(tool, 0.0) + cpu_time
+		
+		elapsed = max((finished for _, finished, _ in rows if finished), default=started) - started
+		summary.update({
+			'remaining': remaining,
+			'workers': len({owner for _, _, owner in rows if owner}),
+			'wall_time': elapsed,
+			'files_per_second': summary['files'] / elapsed if elapsed else 0.0,
+			'mb_per_second': summary['bytes_in'] / 1024 ** 2 / elapsed if elapsed else 0.0,
+		})
+		return summary
+
+	# Write every file's result and the totals across all processes, in the same form as --report.
+	# Processes finishing together may both write it, so it is written aside and renamed into place.
+	def write_report(self, report_file):
+		import json
+		
+		with self.lock:
+			rows = self.db.execute('SELECT result FROM files WHERE result IS NOT NULL ORDER BY path').fetchall()
+		staged = Path(report_file).with_name(f'.{Path(report_file).name}.{os.getpid()}.tmp')
+		with open(staged, 'w', encoding='utf-8') as report:
+			for row in rows:
+				report.write(row[0] + '\n')
+			report.write(json.dumps({'summary': self.summary()}) + '\n')
+		os.replace(staged, report_file)
+
+	# Hand back unstarted files, and print the totals once every file is done. Whichever process finishes last writes `report_file`.
+	def close(self, report_file=None):
+		self.stopped.set()
+		if self.renewer is not None:
+			self.renewer.join()
+		with self.transaction() as db:
+			db.execute('UPDATE files SET state = \'pending\', owner = NULL, expires = NULL, attempts = attempts - 1 WHERE owner = ? AND state = \'leased\'', (self.owner,))
+		
+		summary = self.summary()
+		if not summary['remaining'] and summary['files']:
+			statuses = ', '.join(f'{count} {status}' for status, count in sorted(summary['statuses'].items()))
+			print(f"\nEvery file in the manifest is done. {summary['files']} files ({statuses}) were processed by {summary['workers']} {'worker' if summary['workers'] == 1 else 'workers'} in {summary['wall_time']:.1f} seconds.")
+			print(f"Saved {summary['bytes_saved']} of {summary['bytes_in']} bytes ({summary['bytes_saved'] / max(summary['bytes_in'], 1):.2%}), {summary['files_per_second']:.2f} files/s.")
+			if report_file is not None:
+				self.write_report(report_file)
+		with self.lock:
+			self.db.close()
+
+
+
+# Group files by type and rough size. Small and large files of the same type often gain very differently.
+def file_class(type, size) -> str:
+	for limit, name in ((64 * 1024, '<64K'), (1024 ** 2, '<1M'), (16 * 1024 ** 2, '<16M')):
+		if size < limit:
+			return f'{type} {name}'
+	return f'{type} 16M+'
+
+
+# Keeps running totals of how much each tool saved, and how long it took, for each class of file.
+# Used by `--budget` to stop spending time on tools that don't pay off.
+class ToolStats:
+	# Files a tool must have seen for a class before its numbers are trusted.
+	min_files = 20
+	# Share of files that still get every tool in budget mode, so the numbers keep up with changes in the files.
+	explore_rate = 0.05
+
+	def __init__(self, stats_file):
+		import sqlite3
+		
+		Path(stats_file).parent.mkdir(parents=True, exist_ok=True)
+		self.db = sqlite3.connect(str(stats_file), check_same_thread=False)
+		self.lock = threading.Lock()
+		
+		with self.lock, self.db:
+			self.db.execute('PRAGMA journal_mode=WAL')
+			self.db.execute('PRAGMA synchronous=NORMAL')
+			self.db.execute('''CREATE TABLE IF NOT EXISTS tool_stats (
+				file_class TEXT, tool TEXT, files INTEGER, bytes_in INTEGER, bytes_saved INTEGER, seconds REAL,
+				PRIMARY KEY (file_class, tool))''')
+
+	def record(self, file_class, tool, original_size, new_size, seconds):
+		with self.lock, self.db:
+			self.db.execute('''INSERT INTO tool_stats VALUES (?, ?, 1, ?, ?, ?)
+				ON CONFLICT (file_class, tool) DO UPDATE SET
+				files = files + 1, bytes_in = bytes_in + excluded.bytes_in,
+				bytes_saved = bytes_saved + excluded.bytes_saved, seconds = seconds + excluded.seconds''',
+				(file_class, tool, original_size, original_size - new_size, seconds))
+
+	# Average share of the original size the tool saved, or None if it hasn't seen enough files yet.
+	def gain(self, file_class, tool):
+		with self.lock:
+			row = self.db.execute('SELECT files, bytes_in, bytes_saved FROM tool_stats WHERE file_class = ? AND tool = ?',
+				(file_class, tool)).fetchone()
+		if row is None or row[0] < self.min_files or row[1] == 0:
+			return None
+		return row[2] / row[1]
+
+	def explore(self) -> bool:
+		from random import random
+		return random() < self.explore_rate
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+
+# Pick which of the strategies, listed cheapest first, are worth running for this class of file.
+# A strategy is kept only if it has beaten the best cheaper strategy by at least `min_gain` in the past.
+# Strategies without enough history are always kept so they can build it up.
+def choose_strategies(strategies, stats, file_class, min_gain) -> list:
+	if stats.explore():
+		print("Trying every strategy on this file to keep statistics up to date.")
+		return strategies
+	
+	chosen = []
+	best_gain = 0.0
+	for strategy in strategies:
+		gain = stats.gain(file_class, strategy[0])
+		if gain is None or gain - best_gain >= min_gain:
+			chosen.append(strategy)
+			best_gain = max(best_gain, gain or 0.0)
+		elif best_gain > 0:
+			print(f"Skipping {strategy[0]}. It has saved {gain:.2%} on {file_class} files, not enough over {best_gain:.2%} from cheaper strategies.")
+		else:
+			print(f"Skipping {strategy[0]}. It has saved only {gain:.2%} on {file_class} files.")
+	return chosen
+
+
+### END SUPPORT FUNCTIONS
+
+
+### BEGIN OPTIMIZATION FUNCTIONS
+
+# Commands to optimize files.
+# Each one returns the path of the optimized file, or None if nothing was done to it.
+optimize_msg = "Optimizing {} file."
+
+
+def optimize_7z(file, optimize_7z_contents=False):
+	print(optimize_msg.format("7zip"))
+	
+	# Provides a predictable destination for extracted files. Use this because 7z doesn't have a nice way of getting them otherwise.
+	# A small archive can unpack to far more than the workspace holds, and the workspace is usually in memory.
+	# When the unpacked size can't be found out, the files are unpacked next to the original.
+	workspace = get_workspace()
+	unpacked_size = x7z_unpacked_size(file)
+	extracted = workspace.new_file(file, '', size=unpacked_size if unpacked_size is not None else float('inf'))
+	new_file = workspace.new_file(file, '.7z')
+	try:
+		extracted.mkdir()
+		
+		# Unpack
+		# Lack of space after switch is intentional. 7z's command line interface is bad.
+		print("Extracting 7zip container...")
+		try:
+			if run_tool([x7z, 'x', '-y', f'-o{extracted}', file]).returncode != 0:
+				print(f"{ERROR}7zip could not extract {file}. It may be damaged or encrypted.{ENDC}")
+				return None
+		except OSError:
+			print("Please install 7zip and try again. (https://www.7-zip.org/)")
+			return None
+		
+		# Optionally optimize archive contents.
+		# Do not use the user-set optimization options. Converting files inside an archive would change what is in it.
+		if optimize_7z_contents:
+			print("Optimizing files inside the container...")
+			for extracted_file in walk_files([extracted], recursion=True):
+				optimize_single_file(extracted_file)
+		else:
+			print("Skipping individual file optimization.")
+		
+		# Repack
+		# Includes are relative to the extracted folder so 7z doesn't store the leading folders.
+		content_size = sum(path.stat().st_size for path in walk_files([extracted], recursion=True))
+		print("Creating 7zip container...")
+		# 7zip runs inside the extracted folder, so the archive's path must not be relative.
+		if run_tool([x7z, 'a', *x7z_tuned_options(content_size), new_file.resolve(), '.'], cwd=extracted.resolve()).returncode != 0:
+			print(f"{ERROR}7zip could not repack {file}.{ENDC}")
+			discard_file(new_file)
+			return None
+		
+		# Confirm repack smaller than original
+		return keep_smaller_file(file, new_file)
+	except OSError as error:
+		print(f"{ERROR}Could not repack {file}. ({error}){ENDC}")
+		discard_file(new_file)
+		return None
+	finally:
+		rmtree(extracted, ignore_errors=True)
+
+#def optimize_archive_contents(file, destructive=False):
+	# Delete unecessary resource fork in archives created on Mac computers.
+	# https://en.wikipedia.org/wiki/Resource_fork
+	# https://superuser.com/questions/104500/what-is-macosx-folder
+	#if destructive:
+		# Delete _MACOSX directory.
+		#shutil.rmtree("_MACOSX")
+		# Delete .DS_Store files.
+		#Path.unlink(".DS_Store")
+
+
+def optimize_gz(file, convert_gzip=False, gzip_to_xz=False):
+	print(optimize_msg.format("gzipped"))
+
+	if convert_gzip:
+		import gzip
+		
+		# `logs.tar.gz` becomes `logs.tar.7z`, stored inside as `logs.tar`.
+		decompressed_name = Path(file).with_suffix('').name
+		
+		if not gzip_to_xz and not tools.available(x7z):
+			print("7zip is not installed. Recompressing as xz instead.")
+			gzip_to_xz = True
+		
+		# Decompress in small pieces straight into the new compressor so memory use stays the same for any file size.
+		new_file = None
+		try:
+			if not gzip_to_xz:
+				new_file = get_workspace().new_file(file, '.7z')
+				with gzip.open(file, 'rb') as g:
+					exit_code = stream_to_7z(g, new_file, decompressed_name)
+				if exit_code != 0:
+					print(f"{ERROR}7zip could not compress {file}.{ENDC}")
+					discard_file(new_file)
+					return None
+			
+			if gzip_to_xz:
+				import lzma
+				from shutil import copyfileobj
+				
+				print("Creating xz file...")
+				new_file = get_workspace().new_file(file, '.xz')
+				with gzip.open(file, 'rb') as g, lzma.open(new_file, 'wb', preset=9 | lzma.PRESET_EXTREME) as x:
+					copyfileobj(g, x, stream_chunk_size)
+		except (OSError, EOFError) as error:
+			print(f"{ERROR}Could not recompress {file}. ({error}){ENDC}")
+			# Nothing to clean up if the workspace itself could not be made.
+			if new_file is not None:
+				discard_file(new_file)
+			return None
+		
+		# Check that the new file is smaller than original
+		return keep_smaller_file(file, new_file, Path(file).with_suffix(Path(new_file).suffix))
+	else:
+		print(f"Skipping {file}. Converting gzip to 7zip not enabled.")
+
+
+def optimize_flac(file):
+	print(optimize_msg.format("FLAC"))
+	print(f"Re-compressing {file}...")
+	
+	# Set filename for new file.
+	new_file = get_workspace().new_file(file, '.flac')
+	
+	# Use appropriate command for appropriate system.
+	try:
+		# Compress FLAC at maximum compression.
+		if run_tool([flac, file, '-f', '-V', '--compression-level-8', '-o', new_file]).returncode != 0:
+			print(f"{ERROR}flac could not compress {file}.{ENDC}")
+			discard_file(new_file)
+			return None
+	except OSError:
+		print("Please install `flac` to continue.")
+		return None
+	
+	# Compare file size, delete the smaller one. A wav becomes a .flac file.
+	return keep_smaller_file(file, new_file, Path(file).with_suffix('.flac'))
+
+
+def optimize_jpeg(file, strip_jpg=False):
+	print(optimize_msg.format("JPEG image"))
+
+	if strip_jpg:
+		result = run_tool([jpegoptim, '--strip-all', file])
+	else:
+		print(f"{WARNING}Option `--strip-jpg` not set. Metadata will be untouched.{ENDC}")
+		result = run_tool([jpegoptim, file])
+	
+	if result.returncode == 0:
+		return file
+
+
+def optimize_odf(file, delete_thumbnails=False, ignore_compatibility=False, optimize_zip_contents=False):
+	print(optimize_msg.format("OpenDocument Format file"))
+	
+	# Delete bulky thumbnail from file.
+	#if delete_thumbnails:
+		#print("Removing thumbnail...")
+		
+		#print("Making temp...")
+		#temp_dir = str(Path(file).with_suffix("")) + "_TEMP"
+		
+		## Contents are inside a zip file. Extract it.
+		#run([x7z, 'x', file, f'-o{temp_dir}'])
+		
+		#print("Deleting ", str(Path(temp_dir, 'Thumbnails')))
+		
+		## Delete the contents of `./Thumbnails` directory and itself
+		#rmtree(Path(temp_dir, 'Thumbnails'))
+		
+		## Optimize image files and such embedded in the document?
+		## This is in `./Pictures`
+		## Do not use the user-set optimization options. If a file changes formats, the file index will lose it.
+		##optimize_file(files_in_directory, convert_png=False)
+		
+		#print("Recompressing...")
+		## Recompress to temp file
+		#temp_file = f'{file}.tmp'
+		
+		## Includes must use absolute path or 7zip will include leading folders as well.
+		#include = [ x.resolve() for x in list(Path(temp_dir).glob('*'))]
+		
+		#print(include)
+		
+		## TODO: Both archive managers change the mime-type to `application/zip` instead of `application/vnd.oasis.opendocument.text`
+		## https://docs.oasis-open.org/office/v1.2/os/OpenDocument-v1.2-os-part3.html#__RefHeading__752791_826425813
+		## The mimetype file must be first in the archive and uncompressed.
+		## Consider: https://pypi.org/project/odfdo/
+		#if ignore_compatability:
+			## WARNING: Advzip will automatically exclude empty directories.
+			## This improves file size, but may affect standards compatibility.
+			#run([advzip, '-a4', temp_file, *include])
+		#else:
+			## Deflate is the only algerythm accepted in the OpenDoc standard.
+			#run_tool([x7z, 'a', '-tzip', '-mm=deflate', '-x0', temp_file, *include])
+			#optimize_zip(temp_file)
+		
+		## Delete decompressed directory
+		##rmtree(temp_dir)
+		
+		##keep_smaller_file(file, temp_file)
+	#else:
+		# Recompress it with ADVzip
+	print("Optimizing zip compression.")
+	return optimize_zip(file, optimize_zip_contents=optimize_zip_contents)
+
+
+def optimize_ms_office(file, optimize_zip_contents=False):
+	print(optimize_msg.format("MS Office File"))
+	
+	# Recompress it with ADVzip
+	print("Optimizing zip compression.")
+	return optimize_zip(file, optimize_zip_contents=optimize_zip_contents)
+
+
+#def optimize_pdf(file):
+	# Probably use Ghostscript or something.
+	# https://stackoverflow.com/questions/10450120/optimize-pdf-files-with-ghostscript-or-other
+	# https://askubuntu.com/questions/113544/how-can-i-reduce-the-file-size-of-a-scanned-pdf-file
+	# http://tuxdiary.com/2015/04/07/compress-pdf-files-linux/
+	# Offer OCR?  ocrmypdf
+
+
+# Placeholders in strategy commands for the file being optimized and the candidate being written.
+INPUT = '{input}'
+OUTPUT = '{output}'
+
+
+# Ways to make a smaller PNG, cheapest first. None of them touch the original file.
+# Each is (name, extension of the result, copy the original to the output first, commands to run in order).
+def png_strategies(convert_png=False, use_pngcrush=False) -> list:
+	strategies = [
+		('OptiPNG -o2', '.png', False, [[optipng, '-o2', '-fix', '-out', OUTPUT, INPUT]]),
+		('AdvPNG -z4', '.png', True, [[advpng, '-z4', OUTPUT]]),
+		# AdvPNG should be run last.
+		('OptiPNG -o7 + AdvPNG -z4', '.png', False, [[optipng, '-o7', '-fix', '-out', OUTPUT, INPUT], [advpng, '-z4', OUTPUT]]),
+	]
+	# AdvPNG only writes files it made smaller, so OptiPNG -o7 on its own can never beat the pair. It's only worth running without AdvPNG.
+	if not tools.available(advpng):
+		strategies.append(('OptiPNG -o7', '.png', False, [[optipng, '-o7', '-fix', '-out', OUTPUT, INPUT]]))
+	# PNGCrush hasn't given good results so far, so it is only tried when asked for.
+	if use_pngcrush:
+		strategies.append(('PNGCrush', '.png', False, [[pngcrush, '-q', '-reduce', INPUT, OUTPUT]]))
+	if convert_png:
+		strategies.append(('Lossless WebP', '.webp', False, [[cwebp, '-z', '9', INPUT, '-o', OUTPUT]]))
+	# Leave out strategies whose tools aren't installed.
+	return [strategy for strategy in strategies if all(tools.available(command[0]) for command in strategy[3])]
+
+
+# Produce one candidate. Runs in its own thread so every strategy works at the same time.
+# Started processes are added to `processes` so they can be stopped when the time budget runs out.
+def run_strategy(strategy, file, output, processes, cancelled, usage=None) -> bool:
+	from shutil import copyfile
+	from subprocess import PIPE, STDOUT
+	
+	name, _, copy_first, commands = strategy
+	if copy_first:
+		copyfile(file, output)
+	
+	for command in commands:
+		if cancelled.is_set():
+			return False
+		
+		args = [output if arg is OUTPUT else file if arg is INPUT else arg for arg in command]
+		with cpu_slot():
+			# The time budget may have run out while waiting for a free slot.
+			if cancelled.is_set():
+				return False
+			try:
+				process = start_tool(args, stdout=PIPE, stderr=STDOUT)
+			except OSError:
+				print(f"Skipping {name}. Please install `{Path(command[0]).name}` to use it.")
+				return False
+			processes.append(process)
+			with process.stdout:
+				log = process.stdout.read()
+			wait_for_tool(process, usage)
+		
+		if process.returncode != 0:
+			# Killed processes are expected. Anything else is worth showing.
+			if not cancelled.is_set():
+				print(f"{WARNING}{name} failed:{ENDC}")
+				print(log.decode(errors='replace'), end='')
+			return False
+	
+	return Path(output).exists()
+
+
+# Try every strategy at once and keep whichever gives the smallest file.
+# After `time_budget` seconds, strategies still running are stopped, as long as at least one has already finished.
+# With `stats`, each finished strategy's savings and time are recorded under `file_class`.
+def race_strategies(file, strategies, time_budget=None, stats=None, file_class=None):
+	from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+	from time import monotonic
+	
+	cancelled = threading.Event()
+	processes = []
+	outputs = [get_workspace().new_file(file, suffix) for _, suffix, _, _ in strategies]
+	started = monotonic()
+	durations = {}
+	# Strategies run in their own threads, so hand them this file's usage record.
+	usage = current_tool_usage()
+	strategy_for_file = for_file(run_strategy)
+	
+	def timed_strategy(index):
+		log, ok = strategy_for_file(strategies[index], file, outputs[index], processes, cancelled, usage)
+		durations[index] = monotonic() - started
+		return log, ok
+	
+	try:
+		with ThreadPoolExecutor(max_workers=len(strategies)) as pool:
+			running = {pool.submit(timed_strategy, index): index for index in range(len(strategies))}
+			
+			done, pending = wait(running, timeout=time_budget)
+			# Nothing has worked yet. Keep going until something does so the time spent isn't wasted.
+			while pending and not any(job.result()[1] for job in done):
+				finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+				done |= finished
+			
+			if pending:
+				print(f"Time budget used up. Stopping {', '.join(strategies[running[job]][0] for job in pending)}.")
+				cancelled.set()
+				for process in processes:
+					if process.returncode is None:
+						try:
+							process.kill()
+						except OSError:
+							pass
+			
+			finished = [running[job] for job in done if job.result()[1]]
+		
+		# Show what each strategy had to say, in order.
+		for job in sorted(running, key=running.get):
+			if job.done():
+				print(job.result()[0], end='')
+		
+		# Report every finished candidate, then pick the smallest. Cheaper strategies win ties.
+		sizes = {}
+		info = current_file_info(file)
+		original_size = info.size if info is not None else Path(file).stat().st_size
+		for index in sorted(finished):
+			sizes[index] = outputs[index].stat().st_size
+			print(f"{strategies[index][0]}: {sizes[index]} bytes.")
+			if stats is not None:
+				stats.record(file_class, strategies[index][0], original_size, sizes[index], durations[index])
+		print(f"Tried {len(strategies)} strategies in {monotonic() - started:.1f} seconds.")
+		if not sizes:
+			return None
+		best = min(sizes, key=lambda index: (sizes[index], index))
+		print(f"Best result from {strategies[best][0]}.")
+		
+		# Compare file size, delete the smaller one. A WebP winner is saved with its own extension.
+		return keep_smaller_file(file, outputs[best], Path(file).with_suffix(strategies[best][1]))
+	finally:
+		for output in outputs:
+			discard_file(output)
+
+
+# With `budget`, strategies that haven't saved at least that share of the size on similar files are skipped.
+def optimize_png(file, convert_png=False, use_pngcrush=False, time_budget=None, stats=None, file_class=None, budget=None):
+	# APNGs would be completely broken by the optimizers. sniff_mimetype() finds their Animation Control Chunk so they never reach here.
+	# Consider also: https://sourceforge.net/projects/apng/files/APNG_Optimizer/
+	# And to convert to animated WebP: https://github.com/Benny-/apng2webp
+	
+	print(optimize_msg.format("PNG image"))
+	
+	# Converting to WebP is just another candidate. It is only kept if it is the smallest.
+	if convert_png:
+		print("Trying PNG optimizers and WebP conversion...")
+	else:
+		print("Optimizing PNGs...")
+	
+	strategies = png_strategies(convert_png=convert_png, use_pngcrush=use_pngcrush)
+	# Top level PNGs are checked for their tools before getting here, but images inside containers aren't.
+	if not strategies:
+		print(f"Skipping {file}. It needs `{optipng}` or `{advpng}`.")
+		return None
+	if budget is not None and stats is not None:
+		strategies = choose_strategies(strategies, stats, file_class, budget)
+		if not strategies:
+			print(f"Skipping {file}. No strategy has paid off on {file_class} files.")
+			return None
+	
+	return race_strategies(file, strategies, time_budget=time_budget, stats=stats, file_class=file_class)
+
+
+def optimize_wav(file, convert_wav=False):
+	print(optimize_msg.format("WAV"))
+	
+	if convert_wav:
+		print("Converting wav file to FLAC...")
+		
+		# keep_smaller_file() deletes the wav once the FLAC is safely in place.
+		return optimize_flac(file)
+	else:
+		print("Leaving WAV as is.")
+
+
+#def optimize_rar(file):
+	# TODO: If cbr, convert to cbz. Else, convert to 7z.
+
+
+#def optimize_txt(file):
+	# TODO: Strip trailing white-space off the ends of lines.
+
+
+def optimize_webp(file):
+	print(optimize_msg.format("WebP image"))
+
+	# Set filename for new file.
+	new_file = get_workspace().new_file(file, '.webp')
+
+	try:
+		run_tool([cwebp, '-z', '9', file, '-o', new_file])
+	except OSError:
+		print("Please install `cwebp` and try again.")
+	
+	# Compare file size, delete the smaller one.
+	if Path(new_file).exists():
+			return keep_smaller_file(file, new_file, Path(file).with_suffix('.webp'))
+
+
+def optimize_zip(file, optimize_zip_contents=False):
+	print(optimize_msg.format("Zip container"))
+	
+	if optimize_zip_contents:
+		new_file = optimize_zip_members(file)
+		if new_file is not None:
+			# OpenDocument needs its `mimetype` entry stored uncompressed, which AdvZIP doesn't promise to keep.
+			if not is_odf_archive(new_file):
+				try:
+					run_tool([advzip, '-z4', new_file])
+				except OSError:
+					print("Please install the AdvanceCOMP utilities to improve compression further.")
+			return keep_smaller_file(file, new_file)
+	
+	try:
+		if run_tool([advzip, '-z4', file]).returncode == 0:
+			return file
+	except:
+		print("Please install the AdvanceCOMP utilities and try again.\n",
+			"https://www.advancemame.it/comp-readme")
+
+
+# Images inside containers that are worth optimizing, by extension. Checked again by signature once extracted.
+zip_member_types = ('.png', '.jpg', '.jpeg')
+
+
+def is_odf_archive(file) -> bool:
+	from zipfile import ZipFile
+	with ZipFile(file) as archive:
+		names = archive.namelist()
+	return bool(names) and names[0] == 'mimetype'
+
+
+# Optimize the images inside a zip-based file, then rebuild it in the workspace.
+# Members are streamed one at a time, so large ones are never held in memory.
+# Returns the rebuilt archive, or None if none of the images got smaller.
+def optimize_zip_members(file):
+	from concurrent.futures import ThreadPoolExecutor
+	from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED, BadZipFile
+	from shutil import copyfileobj
+	
+	print("Optimizing files inside the container...")
+	try:
+		archive = ZipFile(file)
+	except BadZipFile as error:
+		print(f"{WARNING}Could not read {file} as a zip file. ({error}){ENDC}")
+		return None
+	
+	workspace = get_workspace()
+	extracted = {}
+	new_file = None
+	try:
+		members = archive.infolist()
+		# Encrypted members can't be copied without the password.
+		if any(info.flag_bits & 0x1 for info in members):
+			print("Skipping contents. Some files in the container are encrypted.")
+			return None
+		
+		for info in members:
+			if not info.is_dir() and info.filename.lower().endswith(zip_member_types):
+				# The member's name is a path inside the archive, not on disk. Room is needed for it unpacked, next to the archive if not in the workspace.
+				extracted[info.filename] = workspace.new_path(info.filename, info.file_size, Path(file).parent)
+				with archive.open(info) as src, open(extracted[info.filename], 'wb') as dst:
+					copyfileobj(src, dst, stream_chunk_size)
+		
+		if not extracted:
+			print("No images to optimize inside the container.")
+			return None
+		
+		# Images inside documents are referred to by name, so they are never converted to another format or stripped of metadata.
+		member_for_file = for_file(optimize_zip_member)
+		with ThreadPoolExecutor(max_workers=min(len(extracted), os.cpu_count() or 1)) as pool:
+			jobs = {name: pool.submit(member_for_file, name, member_file)
+				for name, member_file in extracted.items()}
+			optimized = {}
+			for name, job in jobs.items():
+				# A member that couldn't be optimized is kept as it is. The others still count.
+				try:
+					log, member_output = job.result()
+				except Exception as error:
+					print(f"{WARNING}Could not optimize {name}. Keeping it as it is. ({error}){ENDC}")
+					continue
+				print(log, end='')
+				if member_output is not None and Path(member_output).stat().st_size < archive.getinfo(name).file_size:
+					optimized[name] = Path(member_output)
+		
+		if not optimized:
+			print("None of the images inside the container got smaller.")
+			return None
+		print(f"Optimized {len(optimized)} of {len(extracted)} images inside the container.")
+		
+		# Rebuild the container in the same order. The OpenDocument `mimetype` entry must stay first and uncompressed.
+		# https://docs.oasis-open.org/office/v1.2/os/OpenDocument-v1.2-os-part3.html#__RefHeading__752809_826425813
+		members.sort(key=lambda info: info.filename != 'mimetype')
+		new_file = workspace.new_file(file, Path(file).suffix)
+		with ZipFile(new_file, 'w', compresslevel=9) as rebuilt:
+			rebuilt.comment = archive.comment
+			for info in members:
+				# Members that weren't optimized keep their compressed data as it is. Recompressing would only risk making them bigger.
+				if info.filename not in optimized and not info.is_dir() and (info.filename != 'mimetype' or info.compress_type == ZIP_STORED):
+					copy_zip_member(archive, info, rebuilt)
+					continue
+				
+				new_info = ZipInfo(info.filename, info.date_time)
+				new_info.compress_type = ZIP_STORED if info.filename == 'mimetype' else info.compress_type
+				if new_info.compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+					new_info.compress_type = ZIP_DEFLATED
+				new_info.external_attr = info.external_attr
+				new_info.create_system = info.create_system
+				new_info.comment = info.comment
+				# ZipFile's own compresslevel only applies to write() and writestr() with a name. ZipInfos need it set themselves.
+				new_info._compresslevel = 9
+				
+				if info.is_dir():
+					rebuilt.writestr(new_info, b'')
+					continue
+				
+				source = open(optimized[info.filename], 'rb') if info.filename in optimized else archive.open(info)
+				size = optimized[info.filename].stat().st_size if info.filename in optimized else info.file_size
+				new_info.file_size = size
+				with source, rebuilt.open(new_info, 'w', force_zip64=size > 0x7fffffff) as dst:
+					copyfileobj(source, dst, stream_chunk_size)
+		
+		return new_file
+	except (OSError, BadZipFile, RuntimeError) as error:
+		print(f"{ERROR}Could not rebuild {file}. ({error}){ENDC}")
+		if new_file is not None:
+			discard_file(new_file)
+		return None
+	finally:
+		archive.close()
+		for member_file in extracted.values():
+			discard_file(member_file)
+
+
+# Copy a member's compressed data from one zip to another without unpacking it.
+# zipfile has no way to do this, so it is added the way ZipFile.write() adds members itself.
+# The local header is written with the sizes and CRC up front, so no data descriptor is needed after the data.
+def copy_zip_member(archive, info, rebuilt):
+	import copy
+	import struct
+	
+	new_info = copy.copy(info)
+	new_info.flag_bits &= ~0x08
+	# FileHeader() adds a ZIP64 record when the sizes need one, so an old one is dropped from the extra field.
+	extra, new_info.extra = info.extra, b''
+	while len(extra) >= 4:
+		kind, length = struct.unpack('<HH', extra[:4])
+		if kind != 0x0001:
+			new_info.extra += extra[:4 + length]
+		extra = extra[4 + length:]
+	
+	# The data starts after the local header, whose name and extra field can differ from the central directory's.
+	archive.fp.seek(info.header_offset)
+	header = archive.fp.read(30)
+	if len(header) < 30 or header[:4] != b'PK\x03\x04':
+		raise OSError(f"Damaged local header for {info.filename}.")
+	name_length, extra_length = struct.unpack('<HH', header[26:30])
+	archive.fp.seek(info.header_offset + 30 + name_length + extra_length)
+	
+	with rebuilt._lock:
+		if rebuilt._seekable:
+			rebuilt.fp.seek(rebuilt.start_dir)
+		new_info.header_offset = rebuilt.fp.tell()
+		rebuilt._writecheck(new_info)
+		rebuilt._didModify = True
+		rebuilt.fp.write(new_info.FileHeader())
+		remaining = info.compress_size
+		while remaining:
+			chunk = archive.fp.read(min(remaining, stream_chunk_size))
+			if not chunk:
+				raise OSError(f"{info.filename} is cut short.")
+			rebuilt.fp.write(chunk)
+			remaining -= len(chunk)
+		rebuilt.filelist.append(new_info)
+		rebuilt.NameToInfo[new_info.filename] = new_info
+		rebuilt.start_dir = rebuilt.fp.tell()
+
+
+# Optimize one image taken out of a container. Returns the optimized file, or None.
+def optimize_zip_member(name, member_file):
+	print(f"Optimizing {name} inside the container.")
+	with FileInfo(member_file) as info:
+		type = sniff_mimetype(info)
+	if type == 'image/png':
+		return optimize_png(member_file)
+	elif type == 'image/jpeg':
+		return optimize_jpeg(member_file)
+	print(f"Skipping {name}. It is not a PNG or JPEG after all ({type}).")
+	return None
+
+
+# Commands for the tools that can take many files in one run. They run in order over the whole chunk.
+def batch_commands(kind, strip_jpg=False) -> list:
+	if kind == 'png':
+		# AdvPNG should be run last.
+		return [[optipng, '-o7', '-fix'], [advpng, '-z4']]
+	elif kind == 'jpeg':
+		return [[jpegoptim, '--strip-all']] if strip_jpg else [[jpegoptim]]
+	elif kind == 'zip':
+		return [[advzip, '-z4']]
+
+
+# Optimize a chunk of same-kind files with one run of each tool, then check every file's size on its own.
+# These tools all rewrite files in place and only when the result is smaller.
+# Returns a Result for each file. Time and CPU spent on the chunk are split evenly between its files.
+def run_batch(kind, files, strip_jpg=False, cache=None) -> list:
+	from time import monotonic
+	
+	print(f'{OKGREEN}\nOptimizing {len(files)} {kind} files together.{ENDC}')
+	started = monotonic()
+	usage = ToolUsage()
+	# A batch can be started in the middle of working on the file that filled it up.
+	outer_usage = current_tool_usage()
+	tool_usage.current = usage
+	
+	results = []
+	for file, type in files:
+		try:
+			results.append(Result(str(file), type=type, original_size=Path(file).stat().st_size))
+		except OSError:
+			print(f"{WARNING}{file} disappeared before it could be optimized.{ENDC}")
+			results.append(Result(str(file), type=type, status='failed', message="Disappeared before it could be optimized."))
+	files = [result.path for result in results if result.status != 'failed']
+	if not files:
+		tool_usage.current = outer_usage
+		return results
+	
+	# Only remember files as optimized if every tool ran cleanly.
+	optimized = True
+	try:
+		for command in batch_commands(kind, strip_jpg=strip_jpg):
+			try:
+				optimized &= run_tool(command + files).returncode == 0
+			except OSError:
+				print(f"Please install `{Path(command[0]).name}` to optimize {kind} files.")
+				optimized = False
+	finally:
+		tool_usage.current = outer_usage
+	
+	# Hashing the results for the cache still counts towards the batch.
+	tool_usage.current = usage
+	try:
+		for result in results:
+			if result.status == 'failed':
+				continue
+			result.tools = usage.tools
+			result.wall_time = (monotonic() - started) / len(files)
+			result.cpu_time = usage.cpu_time / len(files)
+			result.tool_times = {tool: cpu_time / len(files) for tool, cpu_time in usage.tool_times.items()}
 			
-			# The output of stdout is not clean. Need to clean it.
-			# Solution: https://python-forum.io/Thread-paramiko-read-stdout
-			type = run(['file', '-b', '--mime-type', file], capture_output=True).stdout.decode('ascii').strip("\n")
-			# The line above is ridiculous but it works.
-		else:
-			print("This script can use Python's default mimetypes module in place of python-magic. Results may be less accurate.\n",
-				"Continue with default mimetypes module?")
-			mimetype_module_choice = confirm()
+			try:
+				result.final_size = Path(result.path).stat().st_size
+			except OSError:
+				print(f"{ERROR}{result.path} is missing after optimization.{ENDC}")
+				result.status = 'failed'
+				result.message = "Missing after optimization."
+				continue
+			result.output = result.path
 			
-			if mimetype_module_choice in accept_options:
-				print("Falling back to default Python mimetypes module.")
-				
-				# https://docs.python.org/3/library/mimetypes.html
-				import mimetypes
+			if result.saved < 0:
+				print(f"{ERROR}{result.path} grew by {-result.saved} bytes. This shouldn't be possible.{ENDC}")
+				result.status = 'failed'
+				result.message = "Grew after optimization."
+			else:
+				print(f'"{result.path}": {result.original_size} -> {result.final_size} bytes (saved {result.saved}).')
+				result.status = 'optimized' if result.saved > 0 else 'unchanged' if optimized else 'failed'
 				
-				# This uses file extensions to guess, which fails if there's no extension, or has the wrong extension. Unreliable.
-				type = mimetypes.guess_type(file)
+				if optimized and cache is not None:
+					cache.add(hash_file(result.path))
+	finally:
+		tool_usage.current = outer_usage
+
+	# Each file was already counted when it was queued.
+	profiler = current_profiler()
+	if profiler is not None:
+		profiler.add(results[0].type, None, usage.stages, files=0)
+	return results
+
+### END OPTIMIZATION FUNCTIONS
+
+
+### START
+
+# The external tools, by name. `tools` finds where each one is installed the first time it's needed.
+x7z = '7z'
+flac = 'flac'
+jpegoptim = 'jpegoptim'
+optipng = 'optipng'
+advpng = 'advpng'
+pngcrush = 'pngcrush'
+cwebp = 'cwebp'
+advzip = 'advzip'
+
+# Where the Windows installers put each tool, under Program Files or the user's local app data.
+windows_tool_paths = {
+	x7z: ('7-Zip\\7z.exe',),
+	flac: ('flac\\win64\\flac.exe', 'flac\\win32\\flac.exe'),
+	jpegoptim: ('jpegoptim\\jpegoptim.exe',),
+	optipng: ('optipng\\optipng.exe',),
+	advpng: ('advancecomp\\advpng.exe',),
+	advzip: ('advancecomp\\advzip.exe',),
+	cwebp: ('libwebp\\bin\\cwebp.exe',),
+	pngcrush: ('pngcrush\\pngcrush.exe',),
+}
+
+# Arguments that make each tool print its version and quit. 7zip prints it in the banner before its usage.
+tool_version_args = {
+	x7z: [],
+	flac: ['--version'],
+	jpegoptim: ['--version'],
+	optipng: ['-v'],
+	advpng: ['--version'],
+	advzip: ['--version'],
+	cwebp: ['-version'],
+	pngcrush: ['-version'],
+}
+
+
+# Finds each external tool once and remembers where it is and whether it runs.
+# Missing tools are then known up front, instead of failing to start once for every file.
+class ToolRegistry:
+	def __init__(self):
+		self.paths = {}
+		self.versions = {}
+		self.warned = set()
+		self.lock = threading.Lock()
+
+	# Full path to the tool, or None if it isn't installed.
+	def path(self, name):
+		with self.lock:
+			if name not in self.paths:
+				self.paths[name] = self.find(name)
+			return self.paths[name]
+
+	@staticmethod
+	def find(name):
+		from shutil import which
+		
+		if not platform.startswith('win32'):
+			return which(name)
+		
+		found = which(f'{name}.exe')
+		if found:
+			return found
+		# 7zFM.exe may be registered, but not 7z.exe. They're likely in the same directory.
+		if name == x7z:
+			try:
+				import winreg
+				registered = winreg.QueryValue(winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\Microsoft\Windows\CurrentVersion\App Paths\7zFM.exe"), None)
+				candidate = Path(registered).with_name('7z.exe')
+				if candidate.exists():
+					return str(candidate)
+			except OSError:
+				pass
+		for base in (os.getenv('ProgramFiles'), os.getenv('LocalAppData'), os.getenv('ProgramFiles(x86)')):
+			if not base:
+				continue
+			for relative in windows_tool_paths.get(name, ()):
+				candidate = Path(base, relative)
+				if candidate.exists():
+					return str(candidate)
+		return None
+
+	# First line the tool prints about itself, or None if it isn't installed or won't run.
+	def version(self, name):
+		from subprocess import run, DEVNULL, PIPE, STDOUT, TimeoutExpired
+		
+		path = self.path(name)
+		with self.lock:
+			if name not in self.versions:
+				self.versions[name] = None
+				if path is not None:
+					try:
+						output = run([path, *tool_version_args.get(name, ['--version'])], stdin=DEVNULL, stdout=PIPE, stderr=STDOUT, timeout=10).stdout
+						lines = [line.strip() for line in output.decode(errors='replace').splitlines() if line.strip()]
+						self.versions[name] = lines[0] if lines else ''
+					except (OSError, TimeoutExpired):
+						pass
+			return self.versions[name]
+
+	def available(self, name) -> bool:
+		return self.version(name) is not None
+
+	# The tools from `names` that can't be used. Each one is pointed out once per run.
+	def missing(self, *names) -> list:
+		missing = [name for name in names if not self.available(name)]
+		for name in missing:
+			with self.lock:
+				if name in self.warned:
+					continue
+				self.warned.add(name)
+			print(f"{WARNING}`{name}` is not installed. Files that need it will be skipped.{ENDC}")
+		return missing
+
+	# Path to run the tool from. Raises FileNotFoundError without trying to start it when it's missing, like a failed start would.
+	def command(self, args) -> list:
+		if not self.available(args[0]):
+			raise FileNotFoundError(errno.ENOENT, "Not installed", args[0])
+		return [self.path(args[0]), *args[1:]]
+
+	def print_table(self):
+		for name in tool_version_args:
+			version = self.version(name)
+			if version is None:
+				print(f"{name:10} {WARNING}not installed{ENDC}")
 			else:
-				print("Stopping script.")
-				# Exit, because this can't do anything if it can't identify file types.
-				exit()
+				print(f"{name:10} {self.path(name)}  {version}")
+
+
+tools = ToolRegistry()
+
+
+
+# Mime-types of the OOXML formats, picked by the top level folder inside the zip.
+ooxml_types = {
+	'word/': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+	'xl/': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+	'ppt/': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+}
+
+
+# Check if a PNG has an Animation Control Chunk. It must come before the first image data, so only the chunks up to there are read.
+# `size` is the file's size. A memory map can't seek past its end, so a chunk claiming to run past it ends the search.
+# https://wiki.mozilla.org/APNG_Specification
+def is_apng(f, size) -> bool:
+	offset = 8
+	while offset + 8 <= size:
+		f.seek(offset)
+		chunk = f.read(8)
+		if len(chunk) < 8:
+			return False
+		length, chunk_type = int.from_bytes(chunk[:4], 'big'), chunk[4:]
+		if chunk_type == b'acTL':
+			return True
+		if chunk_type == b'IDAT':
+			return False
+		# Skip the chunk's data and CRC.
+		offset += 8 + length + 4
+	return False
+
+
+# Pick out the file types this script handles from the first bytes of the file.
+# Much cheaper than libmagic or the `file` command. Returns None if the signature isn't one we know.
+# Takes the file's FileInfo, so nothing is opened again.
+def sniff_mimetype(info):
+	header = info.header(512)
+	if not header:
+		return 'inode/x-empty'
+	if header.startswith(b'\x89PNG\r\n\x1a\n'):
+		return 'image/apng' if is_apng(info.reader(), info.size) else 'image/png'
+	if header.startswith(b'\xff\xd8\xff'):
+		return 'image/jpeg'
+	if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+		return 'image/webp'
+	if header.startswith(b'RIFF') and header[8:12] == b'WAVE':
+		return 'audio/x-wav'
+	if header.startswith(b'fLaC'):
+		return 'audio/flac'
+	if header.startswith(b'\x1f\x8b'):
+		return 'application/gzip'
+	if header.startswith(b"7z\xbc\xaf\x27\x1c"):
+		return 'application/x-7z-compressed'
+	if header.startswith(b'PK\x03\x04'):
+		# OpenDocument and EPUB start with an uncompressed `mimetype` file holding their exact type.
+		# https://docs.oasis-open.org/office/v1.2/os/OpenDocument-v1.2-os-part3.html#__RefHeading__752809_826425813
+		name_length = int.from_bytes(header[26:28], 'little')
+		extra_length = int.from_bytes(header[28:30], 'little')
+		if header[30:30 + name_length] == b'mimetype' and header[8:10] == b'\x00\x00':
+			start = 30 + name_length + extra_length
+			content_type = header[start:start + int.from_bytes(header[18:22], 'little')].decode('ascii', errors='ignore')
+			if content_type.startswith('application/vnd.oasis.opendocument.') or content_type == 'application/epub+zip':
+				return content_type
+		
+		# OOXML files can only be told apart by their contents. Read the zip's central directory to find them.
+		from zipfile import ZipFile, BadZipFile
+		try:
+			with ZipFile(info.handle()) as archive:
+				names = archive.namelist()
+		except (BadZipFile, OSError):
+			# Leave damaged or unusual zips to libmagic.
+			return None
+		if '[Content_Types].xml' in names:
+			for folder, content_type in ooxml_types.items():
+				if any(name.startswith(folder) for name in names):
+					return content_type
+		return 'application/zip'
+	
+	return None
+
+
+# Chooses how to detect the types sniff_mimetype() doesn't know, the first time one turns up. Returns a function taking a file's path.
+# python-magic is best. The `file` command does the same job more slowly. Python's mimetypes module only goes by the file's extension.
+# Nothing is installed automatically, and nothing asks for input, so importing this script never stops to wait.
+@lru_cache(maxsize=None)
+def fallback_mimetype_detector():
+	try:
+		import magic
+		return lambda file: magic.from_file(file, mime=True)
+	except ImportError:
+		print(f"{WARNING}python-magic is not installed. Install it with `pip install python-magic` for the most reliable file type detection.{ENDC}")
+		if platform.startswith('win32'):
+			print(f"{WARNING}On Windows, also install the binaries for Magic with `pip install python-magic-bin==0.4.14`{ENDC}")
+	
+	if tools.available('file'):
+		print("Falling back to using native `file` command to detect mime-type.")
+		from subprocess import run
+		# `--` keeps file names starting with a dash from being read as options.
+		return lambda file: run([tools.path('file'), '-b', '--mime-type', '--', file], capture_output=True).stdout.decode(errors='replace').strip()
+	
+	print(f"{WARNING}Falling back to Python's mimetypes module. Types will be guessed from file extensions, which is less accurate.{ENDC}")
+	import mimetypes
+	return lambda file: mimetypes.guess_type(file)[0] or 'application/octet-stream'
+
+
+# `info` is the file's FileInfo, or None for directories.
+def get_mimetype(file, info=None) -> str:
+	if info is None:
+		type = 'inode/directory'
+	else:
+		# Check the file's signature first. Only fall back to the slower detectors for file types it doesn't know.
+		# A damaged file can fail to parse. Its signature is then treated as unknown.
+		try:
+			type = sniff_mimetype(info)
+		except (OSError, ValueError):
+			type = None
+		if type is None:
+			type = fallback_mimetype_detector()(file)
 
 	print(f"Discovered mime-type to be '{type}'.")
 	return type
 
 
-def optimize_file(*files, 
-		#optimize_7z_contents=False, 
+odf_types = (
+	'application/vnd.oasis.opendocument.text',
+	'application/vnd.oasis.opendocument.spreadsheet',
+	'application/vnd.oasis.opendocument.graphics',
+	'application/vnd.oasis.opendocument.formula',
+	'application/vnd.oasis.opendocument.presentation',
+)
+
+
+# Which tool optimizes each type, for keeping statistics. PNGs try several strategies and are counted per strategy.
+optimizer_tools = {
+	'application/x-7z-compressed': '7z',
+	'application/gzip': 'gzip recompression',
+	'application/x-gzip': 'gzip recompression',
+	'audio/flac': 'flac',
+	'audio/x-flac': 'flac',
+	'audio/x-wav': 'flac',
+	'image/jpeg': 'jpegoptim',
+	'image/webp': 'cwebp',
+	'application/zip': 'advzip',
+	'application/epub+zip': 'advzip',
+	**{type: 'advzip' for type in odf_types},
+	**{type: 'advzip' for type in ooxml_types.values()},
+}
+
+
+# Whether optimize_single_file() has an optimizer for a type. PNGs record their own tools, so they aren't in optimizer_tools.
+# WAVs are left as they are unless they are converted.
+def has_optimizer(type, convert_wav=False) -> bool:
+	if type == 'audio/x-wav':
+		return convert_wav
+	return type == 'image/png' or type in optimizer_tools
+
+
+# Tools a type can't be optimized without. PNGs only need the tools of one strategy, and gzip can fall back on Python's lzma.
+def required_tools(type, convert_png=False, use_pngcrush=False, convert_wav=False, optimize_zip_contents=False) -> list:
+	if type == 'application/x-7z-compressed':
+		return [x7z]
+	elif type in ('audio/flac', 'audio/x-flac') or (type == 'audio/x-wav' and convert_wav):
+		return [flac]
+	elif type == 'image/jpeg':
+		return [jpegoptim]
+	elif type == 'image/webp':
+		return [cwebp]
+	elif type == 'image/png' and not png_strategies(convert_png=convert_png, use_pngcrush=use_pngcrush):
+		return [optipng, advpng]
+	elif not optimize_zip_contents and (type in ('application/zip', 'application/epub+zip') or type in odf_types or type in ooxml_types.values()):
+		return [advzip]
+	return []
+
+
+# Which batch a file can join, if any. Only in-place optimizations can be batched.
+def batch_kind(type, convert_png=False, optimize_zip_contents=False):
+	if type == 'image/png' and not convert_png:
+		return 'png'
+	elif type == 'image/jpeg':
+		return 'jpeg'
+	elif not optimize_zip_contents and (type in ('application/zip', 'application/epub+zip') or type in odf_types or type in ooxml_types.values()):
+		return 'zip'
+	return None
+
+
+# Pre-screening guesses, without running any tools, how much a file could still shrink.
+# Used by `--min-gain` to skip files that earlier optimizers already squeezed.
+# The guesses cover the same files as batch_kind(): in-place optimizations with nothing converted.
+
+# AdvPNG and AdvZIP's deflate usually beats zlib at its best level by a few percent. A file that doesn't is already that good.
+strong_deflate_gain = 0.04
+# Images and archives that need more trial compression than this are always optimized. The guess would cost too much.
+prescreen_limit = 64 * 1024 ** 2
+
+
+# Roughly the size AdvPNG or AdvZIP could get `data` down to. Data that doesn't compress at all stays as it is.
+def best_deflate_size(data) -> int:
+	size = len(zlib.compress(data, 9))
+	if size >= len(data):
+		return len(data)
+	return int(size * (1 - strong_deflate_gain))
+
+
+# Returns the number of bytes the file is expected to lose, or None when there's no telling. Reads it through its FileInfo.
+def estimate_gain(info, kind, strip_jpg=False):
+	from struct import error as StructError
+	from zipfile import BadZipFile
+	
+	try:
+		if kind == 'png':
+			return estimate_png_gain(info)
+		elif kind == 'jpeg':
+			return estimate_jpeg_gain(info, strip_jpg=strip_jpg)
+		elif kind == 'zip':
+			return estimate_zip_gain(info)
+	except (OSError, ValueError, KeyError, StructError, BadZipFile, zlib.error):
+		# Damaged files are left to the tools, which may fix them or say what's wrong.
+		pass
+	return None
+
+
+# Recompress the image data as it is, filters and all. Data zlib can't beat by much was already compressed by something stronger.
+# The header comes first, so images too big to judge are turned away before any image data is read.
+def estimate_png_gain(info):
+	import struct
+	
+	f = info.reader()
+	f.seek(8)
+	length, name = struct.unpack('>I4s', f.read(8))
+	if name != b'IHDR':
+		return None
+	width, height, depth, color, _, _, interlace = struct.unpack('>IIBBBBB', f.read(13))
+	f.seek(4, 1)
+	
+	# Bytes per row, plus the filter byte at the start of each one.
+	channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color]
+	stride = (width * channels * depth + 7) // 8 + 1
+	if interlace or stride * height > prescreen_limit:
+		return None
+	
+	idat = []
+	compressed = 0
+	while True:
+		length, name = struct.unpack('>I4s', f.read(8))
+		if name == b'IDAT':
+			compressed += length
+			# Compressed data bigger than the image it holds is already as bad as it gets.
+			if compressed > prescreen_limit:
+				return None
+			idat.append(f.read(length))
+			f.seek(4, 1)
+		elif name == b'IEND':
+			break
+		else:
+			f.seek(length + 4, 1)
+	
+	data = zlib.decompress(b''.join(idat))
+	# Rows that were never filtered leave OptiPNG plenty to do, whatever the compression. Palette and low bit depth images are best left unfiltered.
+	if color != 3 and depth >= 8 and not any(data[row * stride] for row in range(height)):
+		return None
+	
+	return max(0, compressed - best_deflate_size(data))
+
+
+# The Huffman tables from the JPEG standard. Encoders that don't optimize their tables use these.
+standard_jpeg_tables = (
+	bytes((0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d)),
+	bytes((0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77)),
+)
+
+
+# JPEGOptim's lossless gains come from optimizing the Huffman tables, and from metadata with `--strip-jpg`.
+# With tables already optimized, only the metadata is left.
+def estimate_jpeg_gain(info, strip_jpg=False):
+	import struct
+	
+	metadata = 0
+	f = info.reader()
+	if f.read(2) != b'\xff\xd8':
+		return None
+	while True:
+		marker, length = struct.unpack('>2sH', f.read(4))
+		segment = f.read(length - 2)
+		if marker == b'\xff\xc4':
+			# A DHT segment can hold several tables: class and id, 16 counts, then the symbols.
+			while segment:
+				counts = segment[1:17]
+				if counts in standard_jpeg_tables:
+					return None
+				segment = segment[17 + sum(counts):]
+		elif marker == b'\xff\xfe' or b'\xff\xe1' <= marker <= b'\xff\xef':
+			# Comments and APP1 to APP15. `--strip-all` keeps the JFIF header in APP0.
+			metadata += length + 2
+		elif marker == b'\xff\xda':
+			# Start of the image data. Tables all come before it.
+			break
+	return metadata if strip_jpg else 0
+
+
+# Recompress members the way AdvZIP would. Big archives are judged by a sample from the front, scaled up.
+def estimate_zip_gain(info):
+	from zipfile import ZipFile
+	
+	with ZipFile(info.handle()) as archive:
+		members = [member for member in archive.infolist() if not member.is_dir()]
+		# AdvZIP can't touch encrypted members.
+		if any(member.flag_bits & 0x1 for member in members):
+			return None
+		
+		gain = sampled = read = 0
+		for member in members:
+			if read >= prescreen_limit:
+				break
+			# Only as much of a member is unpacked as the sample still has room for.
+			with archive.open(member) as f:
+				data = f.read(prescreen_limit - read)
+			read += len(data)
+			# The part of the compressed member the sample came from, assuming it compressed evenly.
+			compressed = member.compress_size * len(data) // member.file_size if member.file_size else member.compress_size
+			sampled += compressed
+			# AdvZIP keeps a member as it is when it can't do better, so members never count as growing.
+			gain += max(0, compressed - best_deflate_size(data))
+		
+		total = sum(member.compress_size for member in members)
+	return gain * total // sampled if sampled else None
+
+
+def optimize_single_file(file, 
+		optimize_7z_contents=False, 
 		convert_gzip=False, 
+		gzip_to_xz=False,
 		#delete_thumbnails=False,
 		#ignore_compatibility=False,
 		strip_jpg=False, 
 		convert_png=False, 
+		use_pngcrush=False,
+		png_time_budget=None,
 		convert_wav=False, 
-		#optimize_zip_contents=False, 
-		recursion=False):
+		optimize_zip_contents=False, 
+		cache=None,
+		batch=None,
+		stats=None,
+		budget=None,
+		min_gain=None) -> Result:
+	from time import monotonic
 
-	for file in files:
-		print(f'{OKGREEN}\nCurrent file is "{file}".{ENDC}')
-		
-		# Get the file's mimetype so we can handle it correctly.
+	print(f'{OKGREEN}\nCurrent file is "{file}".{ENDC}')
+	
+	started = monotonic()
+	result = Result(str(file))
+	usage = ToolUsage()
+	# Files inside archives are optimized while the archive is. Their tools also count towards the archive.
+	outer_usage = current_tool_usage()
+	tool_usage.current = usage
+	outer_info = current_file_info()
+	info = None
+	try:
+		# Open the file once for everything read from it here. Directories have nothing to open.
+		# Get the file's mimetype so we can handle it correctly. Reading its signature is cheap, unlike hashing all of it.
 		# Path objects must be converted to strings to work with Magic.
-		type = get_mimetype(str(file))
+		with profiled('detect'):
+			try:
+				info = file_info.current = FileInfo(file)
+			except OSError:
+				if not Path(file).is_dir():
+					raise
+			result.original_size = result.final_size = info.size if info is not None else Path(file).stat().st_size
+			type = result.type = get_mimetype(str(file), info)
+			kind = batch_kind(type, convert_png=convert_png, optimize_zip_contents=optimize_zip_contents)
+		
+		with profiled('pre-check'):
+			# Don't start optimizers that aren't there.
+			missing = tools.missing(*required_tools(type, convert_png=convert_png, use_pngcrush=use_pngcrush, convert_wav=convert_wav, optimize_zip_contents=optimize_zip_contents))
+			if missing:
+				print(f"Skipping {file}. It needs {', '.join(f'`{tool}`' for tool in missing)}.")
+				result.message = f"Not installed: {', '.join(missing)}."
+				return result
+			
+			# Skip files an earlier run already optimized before doing anything expensive.
+			# Only files something can optimize are hashed. Reading the rest in full would cost more than it saves.
+			if cache is not None and info is not None and has_optimizer(type, convert_wav=convert_wav):
+				if cache.is_optimized(info.hash()):
+					print(f"Skipping {file}. It was already optimized with these options.")
+					result.status = 'cached'
+					return result
+			
+			# Don't spend tool time on files that look like they're already as small as they'll get.
+			if min_gain is not None and kind is not None and result.original_size:
+				gain = estimate_gain(info, kind, strip_jpg=strip_jpg)
+				if gain is not None and gain / result.original_size < min_gain:
+					print(f"Skipping {file}. It should shrink by only {gain / result.original_size:.2%}.")
+					result.status = 'prescreened'
+					result.message = f"Predicted to save {gain} bytes."
+					return result
+		
+		# Done reading. The tools get the file to themselves from here on.
+		if info is not None:
+			info.close()
+		
+		# Hand off files the batch tools can take many at once. They are optimized together once enough have been gathered.
+		# Batches need every one of their tools. Without one, files go through the strategies that can still run.
+		if batch is not None and kind is not None and all(tools.available(command[0]) for command in batch_commands(kind)):
+			print(f"Queued {file} to be optimized with other {kind} files.")
+			result.status = 'queued'
+			chunk = batch.add(kind, file, type)
+			if chunk is not None:
+				# Hand back the whole batch's results along with this file's.
+				result.batch_results = run_batch(kind, chunk, strip_jpg=strip_jpg, cache=cache)
+			return result
+		
+		# Stays None unless an optimizer actually ran.
+		output = None
+		
+		# Measure what the optimizer does so --budget can decide what's worth running later.
+		this_class = file_class(type, result.original_size)
+		tool = optimizer_tools.get(type)
+		optimizer_started = monotonic()
+		
+		with profiled('pre-check'):
+			if budget is not None and stats is not None and tool is not None and not stats.explore():
+				gain = stats.gain(this_class, tool)
+				if gain is not None and gain < budget:
+					print(f"Skipping {file}. {tool} has saved only {gain:.2%} on {this_class} files.")
+					result.message = f"{tool} has not paid off on {this_class} files."
+					return result
 		
 		# Choose the correct optimizer to use.
 		# Python does not support case statements. :c
-		if   type == 'application/x-7z-compressed': optimize_7z(file, optimize_7z_contents=False)
-		elif type in ('application/gzip', 'application/x-gzip'): optimize_gz(file, convert_gzip=convert_gzip)
-		elif type in ('audio/flac', 'audio/x-flac'): optimize_flac(file)
-		elif type == 'image/jpeg': optimize_jpeg(file, strip_jpg=strip_jpg)
-		elif type in ('application/vnd.oasis.opendocument.text',
-			'application/vnd.oasis.opendocument.spreadsheet',
-			'application/vnd.oasis.opendocument.graphics',
-			'application/vnd.oasis.opendocument.formula',
-			'application/vnd.oasis.opendocument.presentation'): 
-				optimize_odf(file)
+		if   type == 'application/x-7z-compressed': output = optimize_7z(file, optimize_7z_contents=optimize_7z_contents)
+		elif type in ('application/gzip', 'application/x-gzip'): output = optimize_gz(file, convert_gzip=convert_gzip, gzip_to_xz=gzip_to_xz)
+		elif type in ('audio/flac', 'audio/x-flac'): output = optimize_flac(file)
+		elif type == 'image/jpeg': output = optimize_jpeg(file, strip_jpg=strip_jpg)
+		elif type in odf_types: output = optimize_odf(file, optimize_zip_contents=optimize_zip_contents)
 		#elif type in ('application/msword',
 			#'application/vnd.ms-excel',
 			#'application/vnd.ms-powerpoint',):
 				# Old MS Docs can't be optimized
-		elif type in ('application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-			'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-			'application/vnd.openxmlformats-officedocument.presentationml.presentation'):
-				optimize_ms_office(file)
+		elif type in ooxml_types.values(): output = optimize_ms_office(file, optimize_zip_contents=optimize_zip_contents)
 		#elif type == 'application/pdf': optimize_pdf(file)
-		elif type == 'image/png': optimize_png(file, convert_png=convert_png)
+		elif type == 'image/png': output = optimize_png(file, convert_png=convert_png, use_pngcrush=use_pngcrush, time_budget=png_time_budget,
+			stats=stats, file_class=this_class, budget=budget)
+		elif type == 'image/apng':
+			print(f"Skipping {file}. Animated PNGs would be broken by the PNG optimizers.")
+			result.message = "Animated PNG."
 		#elif type == 'application/x-rar': optimize_rar(file)
 		#elif type == 'text/plain': optimize_txt(file)
-		elif type == 'audio/x-wav': optimize_wav(file, convert_wav=convert_wav)
-		elif type == 'image/webp': optimize_webp(file)
-		elif type in ('application/zip', 'application/epub+zip'): optimize_zip(file, optimize_zip_contents=False)
+		elif type == 'audio/x-wav': output = optimize_wav(file, convert_wav=convert_wav)
+		elif type == 'image/webp': output = optimize_webp(file)
+		elif type in ('application/zip', 'application/epub+zip'): output = optimize_zip(file, optimize_zip_contents=optimize_zip_contents)
 		elif type == 'inode/x-empty':
 			print(f'File "{file}" is empty. Nothing to do.')
+			result.message = "Empty file."
 		elif type == 'inode/directory':
-			print(f"{file} is a directory.")
-			# Recursive function to handle all directories as they come.
-			# TODO: Ensure this will not follow symlinks/shortcuts!
-			if recursion:
-				print(f"Optimizing contents of {file}")
-				new_files = [
-					# Create a list of each item in the directory prepended with relative path.
-					new for new in Path(file).iterdir()
-					]
-				
-				optimize_file(*new_files,
-					#optimize_7z_contents=optimize_7z_contents,
-					convert_gzip=convert_gzip,
-					#delete_thumbnails=delete_thumbnails,
-					strip_jpg=strip_jpg,
-					convert_png=convert_png,
-					convert_wav=convert_wav,
-					#optimize_zip_contents=optimize_zip_contents,
-					recursion=recursion
-					)
-			else:
-				print(f"Skipping {file}. Use `-r` to recursively optimize files inside directories.")
+			# walk_files() expands directories before they get here.
+			print(f"Skipping {file}. It is a directory.")
+			result.message = "Directory."
 		elif type == '':
 			print(f"{ERROR}This file has no mime-type. This shouldn't be possible.{ENDC}")
+			result.message = "No mime-type."
 		else:
 			print(f"No optimizer available for file type '{type}'")
+			result.message = "No optimizer for this type."
+		
+		if output is None:
+			# Tools ran but nothing came of them.
+			if usage.tools:
+				result.status = 'failed'
+			return result
+		
+		result.output = str(output)
+		final_stat = os.stat(output)
+		result.final_size = final_stat.st_size
+		result.status = 'optimized' if result.saved > 0 else 'unchanged'
+		
+		# PNG strategies record their own numbers.
+		if stats is not None and tool is not None:
+			stats.record(this_class, tool, result.original_size, result.final_size, monotonic() - optimizer_started)
+		
+		# Remember the result so the next run can skip it. Converted files are remembered under their new name's contents.
+		# A file nothing was written to still has the hash taken when it was opened.
+		if cache is not None:
+			untouched = info is not None and info.digest is not None and (final_stat.st_ino, final_stat.st_mtime_ns, final_stat.st_size) == (info.stat.st_ino, info.stat.st_mtime_ns, info.stat.st_size)
+			cache.add(info.digest if untouched else hash_file(output))
+		
+		return result
+	except OSError as error:
+		print(f"{ERROR}Failed to optimize {file}: {error}{ENDC}")
+		result.status = 'failed'
+		result.message = str(error)
+		return result
+	finally:
+		if info is not None:
+			info.close()
+		file_info.current = outer_info
+		tool_usage.current = outer_usage
+		if outer_usage is not None:
+			outer_usage.merge(usage)
+		result.tools = usage.tools
+		result.cpu_time = usage.cpu_time
+		result.tool_times = usage.tool_times
+		result.wall_time = monotonic() - started
+		profiler = current_profiler()
+		if profiler is not None:
+			profiler.add(result.type, result.path, usage.stages)
+
+
+# Every Result that came out of optimizing a file, including a batch it completed.
+def all_results(result) -> list:
+	return [result, *result.batch_results]
+
+
+# Optimize one file inside a worker thread and hand back everything it printed, along with the results.
+def optimize_job(file, options):
+	start_buffer()
+	try:
+		with stem_lock(file):
+			results = all_results(optimize_single_file(file, **options))
+	except Exception as error:
+		# One broken file should not take down the rest of the pool.
+		print(f"{ERROR}Failed to optimize {file}: {error}{ENDC}")
+		results = [Result(str(file), status='failed', message=str(error))]
+	return end_buffer(), results
+
+
+# Optimize one batch inside a worker thread and hand back everything it printed, along with the results.
+def batch_job(kind, files, options):
+	start_buffer()
+	try:
+		results = run_batch(kind, files, strip_jpg=options['strip_jpg'], cache=options['cache'])
+	except Exception as error:
+		print(f"{ERROR}Failed to optimize {kind} files {', '.join(str(file) for file, _ in files)}: {error}{ENDC}")
+		results = [Result(str(file), type=type, status='failed', message=str(error)) for file, type in files]
+	return end_buffer(), results
+
+
+# Optimizes files with one set of options. Caches, statistics, the journal, the scratch workspace and the worker threads stay open
+# between calls, so a long-running program can hand it files as they come without paying for setting them up every time.
+#
+#	with Optimizer(strip_jpg=True, jobs=4) as optimizer:
+#		result = optimizer.optimize('photo.jpg')
+#		for result in optimizer.optimize_many(['pictures/', 'backup.zip'], recursion=True):
+#			...
+#
+# What the optimizers print goes to `log` one file at a time, or straight to the terminal as it happens if no `log` is given.
+# Pass `log=open(os.devnull, 'w')` to keep quiet.
+# Options are given as on the command line, so `budget` and `min_gain` are percentages: `min_gain=1` skips files predicted to shrink by less than 1%.
+# Each Optimizer has its own workspace, tool slots and worker threads, so several can be used at once. Each can be called from several threads.
+class Optimizer:
+	def __init__(self,
+			optimize_7z_contents=False,
+			convert_gzip=False,
+			gzip_to_xz=False,
+			#delete_thumbnails=False,
+			#ignore_compatibility=False,
+			strip_jpg=False,
+			convert_png=False,
+			use_pngcrush=False,
+			png_time_budget=None,
+			convert_wav=False,
+			optimize_zip_contents=False,
+			jobs=1,
+			io_jobs=4,
+			batch=False,
+			batch_size=100,
+			use_cache=True,
+			cache_size=100000,
+			budget=None,
+			min_gain=None,
+			scratch_dir=None,
+			resume=False,
+			journal_file=None,
+			stats_file=None,
+			dedup=None,
+			manifest_file=None,
+			lease_time=300.0,
+			manifest_report=None,
+			max_memory=None,
+			profile=False,
+			profile_hooks=(),
+			log=None):
+		
+		self.options = {
+			'optimize_7z_contents': optimize_7z_contents,
+			'convert_gzip': convert_gzip,
+			'gzip_to_xz': gzip_to_xz,
+			#'delete_thumbnails': delete_thumbnails,
+			'strip_jpg': strip_jpg,
+			'convert_png': convert_png,
+			'use_pngcrush': use_pngcrush,
+			'png_time_budget': png_time_budget,
+			'convert_wav': convert_wav,
+			'optimize_zip_contents': optimize_zip_contents,
+		}
+		self.jobs = jobs
+		self.io_jobs = max(io_jobs, 1)
+		self.batch_size = batch_size if batch else None
+		# Kept as fractions of the file size, the way the optimizers compare them.
+		self.budget = None if budget is None else budget / 100
+		self.min_gain = None if min_gain is None else min_gain / 100
+		# None, 'copy' or 'hardlink'. How files with the same contents as one already optimized get its result.
+		self.dedup = dedup
+		# Bytes that the jobs running at once may use between them, going by estimate_memory().
+		self.max_memory = max_memory
+		self.log = log
+		self.pool = None
+		
+		# The cache is keyed on the options above, so it is opened after they are gathered.
+		self.cache = None
+		if use_cache:
+			try:
+				self.cache = ResultCache(default_cache_file(), self.options, max_entries=cache_size)
+			except Exception as error:
+				print(f"{WARNING}Could not open the results cache. Every file will be optimized. ({error}){ENDC}")
+		
+		# Statistics are always gathered so --budget has something to go on when it is used.
+		self.stats = None
+		try:
+			self.stats = ToolStats(stats_file or default_stats_file())
+		except Exception as error:
+			print(f"{WARNING}Could not open the statistics file. ({error}){ENDC}")
+			if budget is not None:
+				print(f"{WARNING}Every optimizer will be used.{ENDC}")
+		
+		# Without `journal_file`, each call to optimize_many() keeps its own journal. See default_journal_file().
+		self.resume = resume
+		self.journal = self.open_journal(journal_file) if journal_file is not None else None
+		
+		# Sharing the run with other processes. Carrying on alone would redo their work, so a manifest that won't open is an error.
+		self.manifest = None
+		self.manifest_report = manifest_report
+		if manifest_file is not None:
+			self.manifest = Manifest(manifest_file, self.options, lease_time=lease_time)
+			if dedup:
+				print(f"{WARNING}--dedup can't be used with a manifest. Each copy will be optimized separately.{ENDC}")
+				self.dedup = None
+		
+		# Made the first time something needs it. See get_workspace().
+		self.workspace = None
+		self.scratch_dir = scratch_dir
+		self.workspace_lock = threading.Lock()
+		# Hooks get every stage whether or not the table is printed at the end.
+		self.profile = profile
+		self.profiler = Profiler(profile_hooks) if profile or profile_hooks else None
+		# With several jobs, there are more workers than tool slots, so files stuck on disk work don't leave a slot unused.
+		self.cpu_slots = threading.BoundedSemaphore(jobs) if jobs > 1 else nullcontext()
+		self.io_slots = threading.BoundedSemaphore(self.io_jobs) if jobs > 1 else nullcontext()
+
+	def get_workspace(self) -> Workspace:
+		with self.workspace_lock:
+			if self.workspace is None:
+				self.workspace = Workspace(self.scratch_dir)
+			return self.workspace
+
+	# Make this the Optimizer the current thread works for, until the block ends.
+	@contextmanager
+	def active(self):
+		outer = current_optimizer()
+		optimizer_context.optimizer = self
+		try:
+			yield
+		finally:
+			optimizer_context.optimizer = outer
+
+	# The worker threads are kept for the next call. Each one works for this Optimizer for as long as it lives.
+	def start_pool(self, workers):
+		if self.pool is None:
+			from concurrent.futures import ThreadPoolExecutor
+			self.pool = ThreadPoolExecutor(max_workers=workers, initializer=setattr, initargs=(optimizer_context, 'optimizer', self))
+		return self.pool
+
+	# Without a journal the run still works, it just can't be resumed.
+	def open_journal(self, journal_file):
+		try:
+			return Journal(journal_file, self.options, resume=self.resume)
+		except Exception as error:
+			print(f"{WARNING}Could not open the journal. ({error}){ENDC}")
+			if self.resume:
+				print(f"{WARNING}Every file will be optimized.{ENDC}")
+			return None
+
+	# Options for optimize_single_file().
+	def file_options(self, batch=None) -> dict:
+		return {**self.options, 'cache': self.cache, 'batch': batch, 'stats': self.stats, 'budget': self.budget, 'min_gain': self.min_gain}
+
+	# Call `function` on behalf of this Optimizer, with what it prints going to the log. Without a log, it goes straight to the terminal.
+	def logged(self, function, *args, **kwargs):
+		with self.active():
+			if self.log is None:
+				return function(*args, **kwargs)
+			start_buffer()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				self.log.write(end_buffer())
+
+	# Pull files from an iterator, with what the directory walk prints going to the log.
+	def logged_files(self, files):
+		if self.log is None:
+			yield from files
+			return
+		while True:
+			file = self.logged(next, files, None)
+			if file is None:
+				return
+			yield file
+
+	# Optimize one file right away. Files are never held back for a batch here.
+	def optimize(self, file) -> Result:
+		with stem_lock(file):
+			return self.logged(optimize_single_file, file, **self.file_options())
+
+	# Optimize each file from an iterable, and each file inside directories when `recursion` is set.
+	# Files are pulled from it only as they are needed. Results are handed back as files finish, which isn't always the order they went in.
+	# Files the journal says an interrupted run finished are left out when resuming.
+	# With `dedup`, only one of each set of files with the same contents is optimized, and the others are given its result as it finishes.
+	# With a manifest, the files are shared with other processes. Files given are only walked if no other process has walked its own yet.
+	def optimize_many(self, files, recursion=False, include=(), exclude=()):
+		# Without a journal given to the Optimizer, a list of files gets its own, which is removed once every file is done.
+		# An iterator can't be resumed, since it may not give the same files again. A manifest keeps track of its files itself.
+		journal = self.journal
+		own_journal = journal is None and self.manifest is None and isinstance(files, (list, tuple))
+		if own_journal:
+			journal = self.open_journal(default_journal_file(files, self.options))
+		
+		if self.manifest is not None:
+			if files:
+				self.manifest.add_source(files, recursion=recursion, include=include, exclude=exclude)
+			files = self.logged_files(self.manifest.claimed(count=self.jobs + self.io_jobs if self.jobs > 1 else 1))
+		else:
+			files = self.logged_files(walk_files(files, recursion=recursion, include=include, exclude=exclude))
+		if journal is not None:
+			files = (file for file in files if not journal.is_finished(file))
+		duplicates = None
+		if self.dedup:
+			duplicates = Duplicates(hardlink=self.dedup == 'hardlink')
+			files = self.logged_files(duplicates.group(files))
+		
+		batch = Batcher(max_files=self.batch_size) if self.batch_size else None
+		options = self.file_options(batch)
+		results = self.run_serially(files, options, batch) if self.jobs <= 1 else self.run_in_pool(files, options, batch)
+		finished = False
+		try:
+			for result in results:
+				# Queued files come back again once their batch is done.
+				if result.status == 'queued':
+					continue
+				for result in [result, *(self.logged(duplicates.apply, result) if duplicates is not None else ())]:
+					if journal is not None:
+						journal.add(result)
+					yield result
+			finished = True
+		finally:
+			# An interrupted run keeps its journal for --resume.
+			if own_journal and journal is not None:
+				self.logged(journal.close, remove=finished)
+
+	# Optimize files as they are written to the given directories, until interrupted with Ctrl+C. Results are handed back as files finish.
+	# A file is only started once nothing has written to it for `delay` seconds, so files still being uploaded are left alone.
+	# Files waiting to start are held here, and only a few per worker are handed to the pool at once.
+	# Batches and --dedup don't apply. Files turn up one at a time.
+	def watch(self, paths, recursion=False, include=(), exclude=(), delay=2.0):
+		from stat import S_ISREG
+		from time import monotonic
+		
+		try:
+			watcher = self.logged(Watcher, paths, recursion=recursion, include=include, exclude=exclude)
+		except OSError as error:
+			print(f"{ERROR}Could not watch for new files. ({error}){ENDC}")
+			return
+		
+		workers = self.jobs + self.io_jobs if self.jobs > 1 else 1
+		self.start_pool(workers)
+		log = self.log or sys.stdout
+		options = self.file_options()
+		
+		# When each file was last written to, oldest first.
+		pending = {}
+		running = {}
+		# What this run left behind, so writing a result doesn't make its file look new.
+		written = {}
+		
+		print(f"Watching {len(watcher.directories)} directories for new files. Press Ctrl+C to stop.")
+		try:
+			while True:
+				timeout = None
+				if pending:
+					timeout = max(next(iter(pending.values())) + delay - monotonic(), 0)
+				if running:
+					# Check on the pool a few times a second.
+					timeout = min(timeout if timeout is not None else 0.2, 0.2)
+				for file in watcher.read(timeout):
+					pending.pop(file, None)
+					pending[file] = monotonic()
+				
+				for job in [job for job in running if job.done()]:
+					del running[job]
+					text, results = job.result()
+					log.write(text)
+					for result in results:
+						self.record_written(result, written)
+						yield result
+				
+				# Start the files that have settled.
+				now = monotonic()
+				while pending and len(running) < workers * 2:
+					file, touched = next(iter(pending.items()))
+					if touched + delay > now:
+						break
+					del pending[file]
+					if file in running.values():
+						# Written again while it was being optimized. Look again once that's done.
+						pending[file] = now
+						continue
+					try:
+						stat = os.stat(file)
+					except OSError:
+						# Already gone, like a temporary file that was renamed.
+						continue
+					if not S_ISREG(stat.st_mode) or written.pop(file, None) == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+						continue
+					running[self.pool.submit(optimize_job, file, options)] = file
+		except KeyboardInterrupt:
+			print("\nStopped watching. Finishing the files already started.")
+			for job in running:
+				text, results = job.result()
+				log.write(text)
+				for result in results:
+					self.record_written(result, written)
+					yield result
+		finally:
+			watcher.close()
+
+	# Remember the file a result was written to, and add it to the journal.
+	def record_written(self, result, written):
+		if self.journal is not None:
+			self.journal.add(result)
+		if result.output is None:
+			return
+		try:
+			stat = os.stat(result.output)
+		except OSError:
+			return
+		written[Path(result.output)] = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+	def run_serially(self, files, options, batch):
+		for file in files:
+			yield from self.finished(all_results(self.logged(optimize_single_file, file, **options)))
+		
+		# Optimize whatever is still waiting for its batch to fill up.
+		if batch is not None:
+			for kind, chunk in batch.drain():
+				yield from self.finished(self.logged(run_batch, kind, chunk, strip_jpg=options['strip_jpg'], cache=options['cache']))
+
+	# Mark files done in the manifest as soon as they are. Waiting for the main thread could keep other processes waiting on them.
+	def finished(self, results) -> list:
+		if self.manifest is not None:
+			for result in results:
+				self.manifest.finish(result)
+		return results
+
+	# Run a pool job, then mark its files done.
+	def finished_job(self, job, *args):
+		text, results = job(*args)
+		return text, self.finished(results)
+
+	def run_in_pool(self, files, options, batch):
+		# Worker threads are enough here. The heavy lifting happens in the external tools, not in Python.
+		workers = self.jobs + self.io_jobs
+		self.start_pool(workers)
+		
+		log = self.log or sys.stdout
+		# With a manifest, don't look ahead. Files held back here would be claimed but not started, while waiting on other processes to finish theirs.
+		window = 1 if self.manifest is not None else 4096
+		scheduler = Scheduler(files, self.options, max_memory=self.max_memory, window=window)
+		yield from run_scheduled(self.pool, workers, scheduler, lambda file: (self.finished_job, optimize_job, file, options), log)
+		
+		# Every file has been looked at, so nothing else can join a batch now.
+		if batch is not None:
+			yield from run_in_pool(self.pool, workers, ((self.finished_job, batch_job, kind, chunk, options) for kind, chunk in batch.drain()), log)
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.shutdown()
+		if self.profile:
+			self.profiler.print_table()
+		if self.manifest is not None:
+			self.manifest.close(self.manifest_report)
+		if self.journal is not None:
+			self.journal.close()
+		if self.cache is not None:
+			self.cache.close()
+		if self.stats is not None:
+			self.stats.close()
+		if self.workspace is not None:
+			self.workspace.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
 
+# Optimize files and directories the way the command line does, printing a summary at the end.
+# With `watch`, the directories are watched for new files instead. See Optimizer.watch().
+# `options` are the same as Optimizer's. Returns the summary.
+def optimize_file(*files, recursion=False, include=(), exclude=(), report_file=None, watch=False, watch_delay=2.0, **options) -> dict:
+	optimizer = Optimizer(**options)
+	try:
+		reporter = Reporter(report_file)
+		try:
+			if watch:
+				results = optimizer.watch(files, recursion=recursion, include=include, exclude=exclude, delay=watch_delay)
+			else:
+				results = optimizer.optimize_many(files, recursion=recursion, include=include, exclude=exclude)
+			for result in results:
+				reporter.add(result)
+		finally:
+			reporter.close()
+	finally:
+		optimizer.close()
+	return reporter.summary()
+
+
+# Feed jobs to the pool and hand back their results as they finish. Returns once every job is done.
+# Each job's log is written to `log` in one piece as soon as it finishes.
+# Only keep a few jobs per worker in flight so huge runs don't queue every file up front.
+def run_in_pool(pool, jobs, tasks, log):
+	from concurrent.futures import wait, FIRST_COMPLETED
+	
+	running = set()
+	task = next(tasks, None)
+	while task is not None or running:
+		while task is not None and len(running) < jobs * 2:
+			running.add(pool.submit(*task))
+			task = next(tasks, None)
+		
+		done, running = wait(running, return_when=FIRST_COMPLETED)
+		for job in done:
+			text, results = job.result()
+			log.write(text)
+			yield from results
+
+
+# Like run_in_pool(), with a Scheduler picking which file starts next. `task` makes the job for a file.
+def run_scheduled(pool, jobs, scheduler, task, log):
+	from concurrent.futures import wait, FIRST_COMPLETED
+	
+	# Memory estimate of each job that has been started.
+	running = {}
+	while True:
+		while len(running) < jobs * 2:
+			picked = scheduler.take(sum(running.values()))
+			if picked is None:
+				break
+			file, memory = picked
+			running[pool.submit(*task(file))] = memory
+		if not running:
+			return
+		
+		done, _ = wait(running, return_when=FIRST_COMPLETED)
+		for job in done:
+			del running[job]
+			text, results = job.result()
+			log.write(text)
+			yield from results
+
+
+
+### BEGIN BENCHMARK
+
+# Bump when the corpus changes, so numbers from an older corpus aren't compared against a newer one.
+bench_corpus_version = 1
+
+# The corpus is random, but always the same random.
+bench_seed = 20240101
+
+# Effort settings a benchmark can be run with. Each is a set of Optimizer options.
+bench_profiles = {
+	'fast': {'png_time_budget': 1.0, 'min_gain': 1.0},
+	'default': {},
+	'batch': {'batch': True},
+	'all': {'strip_jpg': True, 'convert_wav': True, 'optimize_zip_contents': True, 'optimize_7z_contents': True},
+}
+
+# The example tables from the JPEG standard, which most cameras use. Counts of codes of each length, then the symbols.
+# https://www.w3.org/Graphics/JPEG/itu-t81.pdf (Annex K.3)
+standard_dc_table = (bytes((0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0)), bytes(range(12)))
+standard_ac_table = (standard_jpeg_tables[0], bytes.fromhex(
+	'01020300041105122131410613516107227114328191a1082342b1c11552d1f0'
+	'2433627282090a161718191a25262728292a3435363738393a434445464748494a'
+	'535455565758595a636465666768696a737475767778797a838485868788898a'
+	'92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5c6'
+	'c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9fa'))
+
+
+# Lines that look like an application's log. Compresses about as well as the real thing.
+def bench_text(rng, lines) -> bytes:
+	words = ('request', 'cache', 'user', 'session', 'timeout', 'retry', 'connection', 'query', 'worker', 'queue', 'disk', 'token')
+	levels = ('INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING', 'ERROR')
+	text = []
+	for line in range(lines):
+		message = ' '.join(rng.choice(words) for word in range(rng.randint(3, 9)))
+		text.append(f"2024-01-{line // 2000 + 1:02} {line // 100 % 24:02}:{line % 60:02}:{rng.randrange(60):02} {rng.choice(levels)} {message} id={rng.getrandbits(32):08x}\n")
+	return ''.join(text).encode()
+
+
+# An RGB PNG, compressed quickly and without filters the way many programs save them.
+def bench_png(rng, width, height, style) -> bytes:
+	import struct
+	
+	palette = [bytes(rng.randrange(256) for channel in range(3)) for colour in range(6)]
+	rows = []
+	for y in range(height):
+		if style == 'gradient':
+			row = bytes((x * channel + y) & 255 for x in range(width) for channel in (1, 2, 3))
+		elif style == 'flat':
+			# Like a screenshot: a few colours in large blocks.
+			row = b''.join(palette[(x // 32 + y // 24) % len(palette)] for x in range(width))
+		else:
+			# Like a photo: smooth with some noise.
+			row = bytes(((x + y) // 2 + channel * 20 + rng.randrange(12)) & 255 for x in range(width) for channel in range(3))
+		rows.append(b'\x00' + row)
+	
+	def chunk(kind, data):
+		return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+	
+	return (b'\x89PNG\r\n\x1a\n'
+		+ chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+		+ chunk(b'IDAT', zlib.compress(b''.join(rows), 1))
+		+ chunk(b'IEND', b''))
+
+
+# A grey baseline JPEG with the standard tables and a comment, like a camera would save. Sizes must be multiples of 8.
+# Each 8x8 block is a single shade, so only its DC coefficient needs coding and no real encoder is needed.
+def bench_jpeg(rng, width, height, comment) -> bytes:
+	import struct
+	
+	# Canonical Huffman codes from a table's code counts.
+	def codes(table):
+		counts, symbols = table
+		result, code, symbol = {}, 0, iter(symbols)
+		for length, count in enumerate(counts, 1):
+			for n in range(count):
+				result[next(symbol)] = format(code, f'0{length}b')
+				code += 1
+			code <<= 1
+		return result
+	
+	dc_codes, end_of_block = codes(standard_dc_table), codes(standard_ac_table)[0]
+	bits, previous = [], 0
+	for by in range(height // 8):
+		for bx in range(width // 8):
+			# With every quantizer at 8, the quantized DC coefficient is the block's shade minus 128.
+			dc = (bx * 3 + by * 2) % 200 - 100 + rng.randrange(-4, 5)
+			difference, previous = dc - previous, dc
+			category = abs(difference).bit_length()
+			bits.append(dc_codes[category])
+			if category:
+				# Negative numbers are sent as their ones' complement.
+				bits.append(format(difference if difference > 0 else difference + (1 << category) - 1, f'0{category}b'))
+			bits.append(end_of_block)
+	bits = ''.join(bits)
+	# Pad to a whole byte with 1 bits, and stuff a zero after every 0xFF.
+	bits += '1' * (-len(bits) % 8)
+	scan = int(bits, 2).to_bytes(len(bits) // 8, 'big').replace(b'\xff', b'\xff\x00')
+	
+	def segment(marker, data):
+		return b'\xff' + marker + struct.pack('>H', len(data) + 2) + data
+	
+	return (b'\xff\xd8'
+		+ segment(b'\xe0', b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+		+ segment(b'\xfe', comment)
+		+ segment(b'\xdb', b'\x00' + bytes([8] * 64))
+		+ segment(b'\xc0', struct.pack('>BHHB', 8, height, width, 1) + b'\x01\x11\x00')
+		+ segment(b'\xc4', b'\x00' + b''.join(standard_dc_table) + b'\x10' + b''.join(standard_ac_table))
+		+ segment(b'\xda', b'\x01\x01\x00\x00\x3f\x00')
+		+ scan + b'\xff\xd9')
+
+
+# 16-bit mono PCM: a chord with a little noise.
+def bench_wav(rng, seconds, rate=22050) -> bytes:
+	import math
+	import wave
+	from array import array
+	from io import BytesIO
+	
+	tones = [2 * math.pi * rng.uniform(110, 880) / rate for tone in range(3)]
+	samples = array('h', (int(sum(math.sin(tone * i) for tone in tones) * 6000) + rng.randint(-64, 64) for i in range(seconds * rate)))
+	if sys.byteorder == 'big':
+		samples.byteswap()
+	
+	buffer = BytesIO()
+	with wave.open(buffer, 'wb') as w:
+		w.setnchannels(1)
+		w.setsampwidth(2)
+		w.setframerate(rate)
+		w.writeframes(samples.tobytes())
+	return buffer.getvalue()
+
+
+# A zip with quickly compressed members and a fixed date on each, so the same files give the same bytes.
+def bench_zip(members) -> bytes:
+	from io import BytesIO
+	from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+	
+	buffer = BytesIO()
+	with ZipFile(buffer, 'w') as archive:
+		for name, data in members:
+			archive.writestr(ZipInfo(name, date_time=(2024, 1, 1, 0, 0, 0)), data, compress_type=ZIP_DEFLATED, compresslevel=1)
+	return buffer.getvalue()
+
+
+# The smallest Word document Word will open, with a picture in it.
+def bench_docx(rng, paragraphs, picture) -> bytes:
+	text = bench_text(rng, paragraphs).decode()
+	body = ''.join(f'<w:p><w:r><w:t>{line}</w:t></w:r></w:p>' for line in text.splitlines())
+	return bench_zip((
+		('[Content_Types].xml', b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+			b'<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+			b'<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+			b'<Default Extension="xml" ContentType="application/xml"/>'
+			b'<Default Extension="png" ContentType="image/png"/>'
+			b'<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+			b'</Types>'),
+		('_rels/.rels', b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+			b'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+			b'<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+			b'</Relationships>'),
+		('word/document.xml', f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+			f'<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>{body}</w:body></w:document>'.encode()),
+		('word/media/image1.png', picture),
+	))
+
+
+# Write the benchmark corpus to `directory`, which must not exist yet. `scale` multiplies the number of files.
+# Returns a hash of every file's name and contents, to tell whether two benchmarks ran on the same corpus.
+# FLAC files can only be made with `flac`, so they are left out when it isn't installed.
+def bench_corpus(directory, scale=1) -> str:
+	import gzip
+	import hashlib
+	import random
+	import subprocess
+	
+	rng = random.Random(bench_seed)
+	digest = hashlib.blake2b(digest_size=16)
+	directory = Path(directory)
+	
+	def write(name, data):
+		path = directory / name
+		path.parent.mkdir(parents=True, exist_ok=True)
+		path.write_bytes(data)
+		digest.update(name.encode() + b'\0' + data)
+		return path
+	
+	for n in range(scale):
+		for i in range(12):
+			size = (rng.choice((64, 128, 256)), rng.choice((64, 128, 256)))
+			write(f'images/png/{n}-{i}.png', bench_png(rng, *size, ('gradient', 'flat', 'photo')[i % 3]))
+		for i in range(12):
+			comment = bench_text(rng, rng.randint(1, 20))
+			write(f'images/photos/{2020 + i % 3}/{n}-{i}.jpg', bench_jpeg(rng, rng.choice((256, 512, 1024)), rng.choice((256, 384, 768)), comment[:60000]))
+		for i in range(3):
+			wav = write(f'audio/{n}-{i}.wav', bench_wav(rng, rng.randint(1, 3)))
+			# Encoded at the fastest setting, which leaves room for `flac --best`.
+			if tools.available(flac):
+				flac_file = directory / f'audio/flac/{n}-{i}.flac'
+				flac_file.parent.mkdir(parents=True, exist_ok=True)
+				subprocess.run(tools.command([flac, '--silent', '-0', '-o', str(flac_file), str(wav)]), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+				digest.update(flac_file.read_bytes())
+		for i in range(6):
+			write(f'logs/{n}-{i}.log.gz', gzip.compress(bench_text(rng, rng.randint(200, 4000)), compresslevel=1, mtime=0))
+		for i in range(4):
+			members = [(f'data/{m}.log', bench_text(rng, rng.randint(50, 1000))) for m in range(rng.randint(1, 5))]
+			members.append(('images/logo.png', bench_png(rng, 64, 64, 'flat')))
+			write(f'archives/{n}-{i}.zip', bench_zip(members))
+		for i in range(4):
+			write(f'documents/reports/{2020 + i % 2}/{n}-{i}.docx', bench_docx(rng, rng.randint(20, 400), bench_png(rng, 128, 128, 'gradient')))
+	
+	return digest.hexdigest()
+
+
+# Run the optimizers over a fresh copy of the corpus for every profile and job count, and print how fast each was.
+# `save_file` keeps the numbers as a baseline. `compare_file` is an earlier baseline to compare against.
+# Everything is written under `directory` (a temporary directory if not given), so the disk being measured can be picked.
+# Neither the results cache nor the statistics and journal of normal runs are touched.
+def run_benchmark(directory=None, jobs=(1,), profiles=('default',), scale=1, save_file=None, compare_file=None, scratch_dir=None) -> dict:
+	import json
+	import tempfile
+	from shutil import copytree
+	
+	baseline = None
+	if compare_file is not None:
+		with open(compare_file, encoding='utf-8') as f:
+			baseline = json.load(f)
+	
+	base = Path(tempfile.mkdtemp(prefix='optimize-bench-', dir=directory))
+	try:
+		corpus = base / 'corpus'
+		print(f"Generating the benchmark corpus in {corpus}.")
+		digest = bench_corpus(corpus, scale)
+		files = sum(1 for file in corpus.rglob('*') if file.is_file())
+		print(f"{files} files, {sum(file.stat().st_size for file in corpus.rglob('*') if file.is_file())} bytes.\n")
+		
+		runs = {}
+		for profile in profiles:
+			for job_count in jobs:
+				name = f'{profile} -J{job_count}'
+				work, state = base / 'work', base / 'state'
+				copytree(corpus, work)
+				state.mkdir()
+				try:
+					with open(os.devnull, 'w') as log, Optimizer(jobs=job_count, use_cache=False, scratch_dir=scratch_dir,
+							journal_file=state / 'journal.sqlite', stats_file=state / 'stats.sqlite', log=log, **bench_profiles[profile]) as optimizer:
+						reporter = Reporter()
+						for result in optimizer.optimize_many([work], recursion=True):
+							reporter.add(result)
+						runs[name] = reporter.summary()
+				finally:
+					rmtree(work)
+					rmtree(state)
+				print_bench_run(name, runs[name], baseline['runs'].get(name) if baseline else None)
+	finally:
+		rmtree(base)
+	
+	report = {
+		'corpus_version': bench_corpus_version,
+		'corpus_digest': digest,
+		'scale': scale,
+		'python': sys.version.split()[0],
+		# Tool versions matter as much as this script's, so they are kept alongside.
+		'tools': {name: tools.version(name) for name in sorted({tool for run in runs.values() for tool in run['tool_times']})},
+		'runs': runs,
+	}
+	
+	if baseline is not None and (baseline.get('corpus_version'), baseline.get('corpus_digest')) != (bench_corpus_version, digest):
+		print(f"{WARNING}The baseline was measured on a different corpus, so the numbers may not be comparable.{ENDC}")
+	if baseline is not None and baseline.get('tools') != report['tools']:
+		print(f"{WARNING}The baseline was measured with different tool versions.{ENDC}")
+	
+	if save_file is not None:
+		Path(save_file).parent.mkdir(parents=True, exist_ok=True)
+		with open(save_file, 'w', encoding='utf-8') as f:
+			json.dump(report, f, indent='\t')
+		print(f"\nSaved the baseline to {save_file}.")
+	return report
+
+
+# One benchmark run's numbers, with the change from the baseline's run of the same name.
+def print_bench_run(name, run, baseline=None):
+	def change(key):
+		if not baseline or not baseline.get(key):
+			return ''
+		ratio = run[key] / baseline[key] - 1
+		# Within a few percent is as good as unchanged. Timing is noisy.
+		colour = ERROR if ratio < -0.05 else OKGREEN if ratio > 0.05 else ''
+		return f" ({colour}{ratio:+.1%}{ENDC if colour else ''})"
+	
+	print(f"{name}: {run['files']} files in {run['wall_time']:.2f} seconds.")
+	print(f"\t{run['files_per_second']:.2f} files/s{change('files_per_second')}, {run['mb_per_second']:.2f} MB/s{change('mb_per_second')}, "
+		f"saved {run['bytes_saved']} bytes{change('bytes_saved')}.")
+	if run['tool_times']:
+		print('\t' + ', '.join(f'{tool} {cpu_time:.2f}s' for tool, cpu_time in sorted(run['tool_times'].items(), key=lambda item: -item[1])) + ' of CPU time.')
+
+### END BENCHMARK
 
 
 # If script is run as the main file, gather arguments to use.
@@ -719,11 +4156,31 @@ if __name__ == "__main__":
 	# Set up command line arguments so they can be processed.
 	args = define_arguments()
 	
+	if args.list_tools:
+		tools.print_table()
+		exit()
+	
+	if args.bench is not None:
+		profiles = args.bench_profiles.split(',')
+		unknown = [profile for profile in profiles if profile not in bench_profiles]
+		if unknown:
+			print(f"{ERROR}Unknown benchmark profile: {', '.join(unknown)}. Choose from {', '.join(bench_profiles)}.{ENDC}")
+			exit(1)
+		jobs = [int(count) for count in args.bench_jobs.split(',')] if args.bench_jobs else sorted({1, os.cpu_count() or 1})
+		run_benchmark(args.bench or None,
+			jobs=jobs,
+			profiles=profiles,
+			scale=args.bench_scale,
+			save_file=args.bench_save,
+			compare_file=args.bench_compare,
+			scratch_dir=args.scratch_dir)
+		exit()
+	
 	if args.all_optimizations == 1:
 		args.strip_jpg = True
 		args.convert_wav = True
-		#args.optimize_zip_contents = True
-		#args.optimize_7z_contents = True
+		args.optimize_zip_contents = True
+		args.optimize_7z_contents = True
 	elif args.all_optimizations >= 2:
 		args.convert_gzip = True
 		#args.delete_thumbnails = True
@@ -731,24 +4188,51 @@ if __name__ == "__main__":
 		args.convert_png = True
 		args.convert_wav = True
 		#args.ignore_compatibility = True
-		#args.optimize_zip_contents = True
-		#args.optimize_7z_contents = True
+		args.optimize_zip_contents = True
+		args.optimize_7z_contents = True
 	
 	
 	# Pass all required argument options to the optimize function so global vars are not needed.
 	optimize_file(*args.files, 
-		#optimize_7z_contents=args.optimize_7z_contents,
+		optimize_7z_contents=args.optimize_7z_contents,
 		convert_gzip=args.convert_gzip,
+		gzip_to_xz=args.gzip_to_xz,
 		#delete_thumbnails=args.delete_thumbnails,
 		strip_jpg=args.strip_jpg,
 		convert_png=args.convert_png,
+		use_pngcrush=args.use_pngcrush,
+		png_time_budget=args.png_time_budget,
 		convert_wav=args.convert_wav,
-		#optimize_zip_contents=args.optimize_zip_contents,
-		recursion=args.use_recursion
+		optimize_zip_contents=args.optimize_zip_contents,
+		recursion=args.use_recursion,
+		include=args.include,
+		exclude=args.exclude,
+		jobs=args.jobs,
+		io_jobs=args.io_jobs,
+		batch=args.batch,
+		batch_size=args.batch_size,
+		use_cache=args.use_cache,
+		cache_size=args.cache_size,
+		# Given as a percentage, used as a fraction.
+		budget=args.budget,
+		min_gain=args.min_gain,
+		scratch_dir=args.scratch_dir,
+		report_file=args.report_file,
+		resume=args.resume,
+		journal_file=args.journal_file,
+		dedup=args.dedup,
+		watch=args.watch,
+		watch_delay=args.watch_delay,
+		manifest_file=args.manifest_file,
+		lease_time=args.lease_time,
+		manifest_report=args.manifest_report,
+		max_memory=args.max_memory,
+		profile=args.profile,
+		profile_hooks=args.profile_hooks
 		)
 		
 	### DONE! ###
-	if not args.files:
+	if not args.files and not args.manifest_file:
 		print("No files given. If you'd like to optimize all files in the current directory, use a wildcard.\n")
 		if platform.startswith('linux'):
 			print("In Bash, use the * character.")